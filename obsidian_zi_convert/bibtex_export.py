@@ -0,0 +1,126 @@
+import json
+import os
+import re
+
+from bibtex_json_stream import BibEntry
+from file_io import write_file_if_changed
+
+# Zotero item type -> BibTeX entry type, everything else is exported as @misc
+BIBTEX_ENTRY_TYPES = {
+    'journalArticle': 'article',
+    'magazineArticle': 'article',
+    'newspaperArticle': 'article',
+    'preprint': 'article',
+    'book': 'book',
+    'bookSection': 'incollection',
+    'conferencePaper': 'inproceedings',
+    'thesis': 'phdthesis',
+    'report': 'techreport',
+    'patent': 'patent',
+    'webpage': 'online',
+}
+
+# verbatim fields of BibTeX/biblatex, e.g. "_" of a DOI or "%20" of a URL are not escaped
+VERBATIM_FIELDS = ('doi', 'url')
+
+BIBTEX_KEY_PATTERN = re.compile(r'^\s*@\w+\s*\{\s*([^,\s]+)\s*,', re.MULTILINE)
+
+
+def get_bibtex_authors(creators):
+
+    authors = []
+    for creator in creators:
+        if creator.get('creatorType', 'author') != 'author':
+            continue
+        if 'lastName' in creator:
+            if creator.get('firstName'):
+                authors.append('{}, {}'.format(creator['lastName'], creator['firstName']))
+            else:
+                authors.append(creator['lastName'])
+        elif 'name' in creator:
+            # institutional authors, protect from being split into first and last names
+            authors.append('{' + creator['name'] + '}')
+
+    return ' and '.join(authors)
+
+
+def clean_bibtex_value(value, verbatim: bool = False):
+
+    value = str(value)
+    # unbalanced braces would break the whole .bib file
+    if value.count('{') != value.count('}'):
+        value = value.replace('{', '').replace('}', '')
+    if verbatim:
+        return value
+    return re.sub(r'(?<!\\)([&%#$_])', r'\\\1', value)
+
+
+def format_bibtex_entry(citation_key: str, entry, year: str):
+
+    fields = [
+        ('author', get_bibtex_authors(entry.get('creators', ()))),
+        ('title', entry.get('title')),
+        ('journal', entry.get('publicationTitle')),
+        ('year', year if year != '????' else None),
+        ('volume', entry.get('volume')),
+        ('number', entry.get('issue')),
+        ('pages', entry.get('pages')),
+        ('doi', entry.get('DOI')),
+        ('url', entry.get('url')),
+    ]
+    entry_type = BIBTEX_ENTRY_TYPES.get(entry.get('itemType'), 'misc')
+
+    lines = ['@{}{{{},'.format(entry_type, citation_key)]
+    for name, value in fields:
+        if value:
+            lines.append('  {} = {{{}}},'.format(name, clean_bibtex_value(value, verbatim=name in VERBATIM_FIELDS)))
+    lines.append('}\n\n')
+
+    return '\n'.join(lines)
+
+
+def get_used_citation_keys(markdown_links):
+    # unique keys in the order of the first citation
+    return list(dict.fromkeys(key for key, _ in markdown_links))
+
+
+def read_existing_bibliography(bib_path: str):
+    """
+    Returns the Better BibTeX JSON items of an existing .json output, or the citation keys of a .bib output
+    """
+    if not os.path.exists(bib_path) or os.path.getsize(bib_path) == 0:
+        return [] if bib_path.endswith('.json') else set()
+
+    if bib_path.endswith('.json'):
+        with open(bib_path, 'r') as f:
+            return json.load(f).get('items', [])
+
+    with open(bib_path, 'r') as f:
+        return set(BIBTEX_KEY_PATTERN.findall(f.read()))
+
+
+def get_existing_citation_keys(existing):
+    if isinstance(existing, list):
+        return {item['citationKey'] for item in existing}
+    return existing
+
+
+def write_subset_bibliography(bib_path: str, entries: list, existing):
+    """
+    Add the (citation_key, entry, year) entries to the output bibliography. Output .json is written as
+    Better BibTeX JSON "items", anything else is appended entry by entry as BibTeX
+    """
+    if len(entries) == 0:
+        # nothing new, do not touch the file (e.g. Dropbox would re-upload it)
+        return
+
+    if bib_path.endswith('.json'):
+        # always the compact records, so that the output does not depend on whether the entries came from
+        # the full Zotero export or from the streaming parser/cache
+        items = existing + [BibEntry(entry).to_dict() for _, entry, _ in entries]
+        text = '{"items": [\n' + ',\n'.join(json.dumps(item) for item in items) + '\n]}\n'
+        write_file_if_changed(bib_path, text)
+    else:
+        with open(bib_path, 'a') as f:
+            for citation_key, entry, year in entries:
+                f.write(format_bibtex_entry(citation_key, entry, year=year))
@@ -0,0 +1,140 @@
+import json
+import logging
+
+# Read the export in 1 MB chunks, the buffer grows only if a single JSON value is larger than that
+CHUNK_SIZE = 2 ** 20
+
+# Only the fields used by get_author_naming(), get_year() and get_article_hyperlink(), and the basic
+# fields of the exported subset bibliography are kept, the abstracts, notes, attachments, etc.
+# of the Zotero export are dropped item by item
+ENTRY_FIELDS = ('citationKey', 'itemType', 'creators', 'date', 'issueDate', 'url', 'DOI',
+                'publicationTitle', 'libraryCatalog', 'title', 'volume', 'issue', 'pages')
+CREATOR_FIELDS = ('lastName', 'firstName', 'name', 'creatorType')
+
+
+class BibEntry:
+    """
+    Compact slotted record of one Better BibTeX JSON item. Supports the dict-style access that the
+    citation formatting uses, i.e. entry['date'] raises KeyError when the item did not have a date
+    """
+
+    __slots__ = ENTRY_FIELDS
+
+    def __init__(self, item: dict):
+        for field in ENTRY_FIELDS:
+            if field in item:
+                value = item[field]
+                if field == 'creators':
+                    value = tuple({k: creator[k] for k in CREATOR_FIELDS if k in creator}
+                                  for creator in value)
+                setattr(self, field, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return field in ENTRY_FIELDS and hasattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in ENTRY_FIELDS else default
+
+    def keys(self):
+        return [field for field in ENTRY_FIELDS if hasattr(self, field)]
+
+    def to_dict(self):
+        entry = {field: getattr(self, field) for field in self.keys()}
+        if 'creators' in entry:
+            entry['creators'] = list(entry['creators'])
+        return entry
+
+
+class JsonStreamReader:
+    """
+    Minimal incremental reader on top of json.JSONDecoder.raw_decode(), so that one JSON value
+    is decoded at a time instead of reading and parsing the whole file at once
+    """
+
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # read at least as much as is still unparsed, so that re-decoding a large value
+        # after a partial read stays linear in its size
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Malformed JSON, expected '{}' but found '{}'".format(char, found))
+        self.pos += 1
+
+    def skip_if(self, char: str):
+        if self.peek() == char:
+            self.pos += 1
+            return True
+        return False
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the very end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_betterbibtex_items(json_path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Yield the entries of the "items" array of a Better BibTeX JSON export one at a time
+    """
+    with open(json_path, 'r') as f:
+        reader = JsonStreamReader(f, chunk_size=chunk_size)
+        reader.expect('{')
+        while not reader.skip_if('}'):
+            key = reader.decode_value()
+            reader.expect(':')
+            if key == 'items':
+                reader.expect('[')
+                while not reader.skip_if(']'):
+                    yield reader.decode_value()
+                    reader.skip_if(',')
+            else:
+                # "config", "version", "collections", small compared to the items
+                reader.decode_value()
+            reader.skip_if(',')
+
+
+def load_betterbibtex_json_stream(json_path: str):
+
+    items = [BibEntry(item) for item in iter_betterbibtex_items(json_path)]
+    logging.info("Streamed {} biblio entries from {}".format(len(items), json_path))
+
+    return {'items': items}
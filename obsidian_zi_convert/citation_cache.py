@@ -0,0 +1,78 @@
+import logging
+import os
+import sqlite3
+from contextlib import closing
+
+# bump when the table layout or the citation formatting changes, so that old caches get rebuilt
+CACHE_SCHEMA_VERSION = 3
+
+
+def get_citation_cache_path(bib_path: str):
+    return bib_path + '.citations.sqlite'
+
+
+def get_source_fingerprint(bib_path: str):
+    # size + mtime instead of hashing the (possibly several hundred MB) export on every run
+    stat = os.stat(bib_path)
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def load_citation_cache(cache_path: str, fingerprint: str):
+    """
+    Returns {citation_key: (citation_string, hyperlink)} and {citation_key: compact entry as JSON string},
+    or None, None if there is no cache, or the cache was compiled from another version of the export
+    """
+    if not os.path.exists(cache_path):
+        return None, None
+
+    try:
+        with closing(sqlite3.connect(cache_path)) as con:
+            meta = dict(con.execute('SELECT name, value FROM meta'))
+            if meta.get('schema_version') != str(CACHE_SCHEMA_VERSION):
+                logging.info("Citation cache {} is from an older version, rebuilding".format(cache_path))
+                return None, None
+            if meta.get('source_fingerprint') != fingerprint:
+                logging.info("Input bibtex file changed since {} was compiled, rebuilding".format(cache_path))
+                return None, None
+            citations, entries_json = {}, {}
+            for key, citation_string, hyperlink, entry_json in (
+                    con.execute('SELECT citation_key, citation_string, hyperlink, entry FROM citations')):
+                # NULL citation string: the entry could not be formatted, it is retried if cited
+                if citation_string is not None:
+                    citations[key] = (citation_string, hyperlink)
+                entries_json[key] = entry_json
+    except sqlite3.DatabaseError as e:
+        logging.warning("Could not read the citation cache {}, rebuilding: {}".format(cache_path, e))
+        return None, None
+
+    logging.info("Loaded {} compiled citations from {}".format(len(citations), cache_path))
+
+    return citations, entries_json
+
+
+def save_citation_cache(cache_path: str, fingerprint: str, citations: dict, entries_json: dict):
+
+    # write to a temp file and swap it in, so that an interrupted run does not leave a half-written cache
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    try:
+        with closing(sqlite3.connect(tmp_path)) as con:
+            with con:
+                con.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+                con.execute('CREATE TABLE citations '
+                            '(citation_key TEXT PRIMARY KEY, citation_string TEXT, hyperlink TEXT, entry TEXT)')
+                con.executemany('INSERT INTO meta VALUES (?, ?)',
+                                [('schema_version', str(CACHE_SCHEMA_VERSION)),
+                                 ('source_fingerprint', fingerprint)])
+                con.executemany('INSERT INTO citations VALUES (?, ?, ?, ?)',
+                                ((key, *citations.get(key, (None, None)), entries_json.get(key))
+                                 for key in citations.keys() | entries_json.keys()))
+        os.replace(tmp_path, cache_path)
+    except (sqlite3.Error, OSError) as e:
+        # the cache is only an optimization, the conversion works without it
+        logging.warning("Could not write the citation cache {}: {}".format(cache_path, e))
+        return
+
+    logging.info("Compiled {} citations to {}".format(len(citations), cache_path))
@@ -1,10 +1,26 @@
 import argparse
 import glob
+import itertools
 import json
 import os
 
 import logging
+import multiprocessing
 import re
+import time
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from bibtex_export import (get_existing_citation_keys, get_used_citation_keys, read_existing_bibliography,
+                           write_subset_bibliography)
+from bibtex_json_stream import BibEntry, load_betterbibtex_json_stream
+from citation_cache import (get_citation_cache_path, get_source_fingerprint, load_citation_cache,
+                            save_citation_cache)
+from file_io import write_file_if_changed
+from manifest import (MANIFEST_FILENAME, get_manifest_path, load_manifest, save_manifest, filter_changed_md_files,
+                      update_manifest)
+from run_report import build_run_report, create_file_report, log_run_report, save_run_report
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +65,51 @@ def parse_args_to_dict():
         default='/home/petteri/Dropbox/manuscriptDrafts/obsidian_zi_convert/CVT_test',
         help="Where the .md files are located. Assuming that this is one vault with shared Zotero db",
     )
+    parser.add_argument(
+        "-parser",
+        "--parser-method",
+        type=str,
+        required=False,
+        default="betterbibtex_json",
+        choices=["betterbibtex_json", "betterbibtex_json_stream"],
+        help="'betterbibtex_json_stream' parses the export item by item and keeps only the fields needed "
+             "for the citations, use for large Zotero exports that do not fit comfortably in memory",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of worker processes converting the .md files in parallel",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        required=False,
+        default=0,
+        help="Pipelined mode for slow (network/synced) filesystems: read and write the .md files with this "
+             "many threads while converting (combine with --jobs to convert in several processes)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Convert all the .md files, by default only the files that are new or modified since the previous run "
+             "(or all of them if the input bibtex file changed) are converted, see " + MANIFEST_FILENAME,
+    )
+    parser.add_argument(
+        "--report-file",
+        type=str,
+        required=False,
+        default=None,
+        help="Save a run report (per-file counts, per-key hits, missing keys, timings) as .json or .csv",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read/write the compiled citations cache (.citations.sqlite next to the input file), "
+             "by default the cache is rebuilt only when the input file changes",
+    )
 
     args_dict = vars(parser.parse_args())
     print_dict_to_logger(args_dict)
@@ -66,28 +127,135 @@ def list_md_files_in_dir(dir_in: str):
     return files
 
 
-def create_bibtex(bib_path: str):
-    # TODO!
-    return None
-
-
-def get_citation_keys_from_json_dict(bibtex_in):
-
-    citation_keys = []
-    for item in bibtex_in['items']:
-        citation_keys.append(item['citationKey'])
+def create_bibtex(bib_path: str, bibtex_in, markdown_links: list):
+    """
+    Export the subset of the biblio entries that were actually cited in the converted .md files.
+    The entries already in bib_path are kept, i.e. the output accumulates over (incremental) runs
+    """
+    citation_index = bibtex_in['citation_index']
+    existing = read_existing_bibliography(bib_path)
+    existing_keys = get_existing_citation_keys(existing)
+
+    entries = []
+    for citation_key in get_used_citation_keys(markdown_links):
+        if citation_key not in existing_keys:
+            entry = citation_index.get_entry(citation_key)
+            if entry is not None:
+                entries.append((citation_key, entry, get_year(entry)))
+            else:
+                logging.warning("No biblio entry to export for @{}".format(citation_key))
+
+    write_subset_bibliography(bib_path, entries, existing)
+    logging.info("Exported {} new cited entries to {} ({} entries were there already)".
+                 format(len(entries), bib_path, len(existing_keys)))
+
+    return bib_path
+
+
+# what get_author_naming() / get_year() raise for the entries they cannot handle (missing fields etc.)
+CITATION_FORMAT_ERRORS = (KeyError, IndexError, TypeError, AttributeError, UnboundLocalError)
+
+
+class CitationIndex:
+    """
+    Hash-based citation key -> biblio entry lookup, built once from the imported items, or from
+    the precompiled (citation string, hyperlink) pairs of the citation cache.
+    The formatted Markdown hyperlinks are memoized per key, so repeated citations of the same
+    paper are not reformatted for every occurrence in the vault
+    """
+
+    def __init__(self, items=(), citations: dict = None, entries_json: dict = None, version: str = None):
+        self.entries = {}
+        for item in items:
+            # keep the first entry for duplicate keys (as list.index() did before)
+            self.entries.setdefault(item['citationKey'], item)
+        self._citations = dict(citations) if citations is not None else {}
+        # compact entries of the citation cache, decoded only when needed (i.e. for the output bibliography)
+        self._entries_json = entries_json if entries_json is not None else {}
+        self._hyperlinks = {}
+        # the keys whose entries could not be formatted, so that they are not reformatted for every citation
+        self._format_errors = {}
+        # fingerprint of the biblio export that the index was built from
+        self.version = version
+
+    def __len__(self):
+        return max(len(self.entries), len(self._citations))
+
+    def __contains__(self, citation_key):
+        return (citation_key in self.entries or citation_key in self._citations
+                or self._entries_json.get(citation_key) is not None)
+
+    def get_entry(self, citation_key):
+        if citation_key not in self.entries and self._entries_json.get(citation_key) is not None:
+            self.entries[citation_key] = BibEntry(json.loads(self._entries_json[citation_key]))
+        return self.entries.get(citation_key)
+
+    def get_entries_json(self):
+        return {citation_key: json.dumps(BibEntry(entry).to_dict())
+                for citation_key, entry in self.entries.items()}
+
+    def get_citation(self, citation_key):
+        # raises KeyError if the key is not in the index, check with "in" first, and one of the
+        # CITATION_FORMAT_ERRORS if the entry cannot be formatted
+        if citation_key in self._format_errors:
+            raise self._format_errors[citation_key].with_traceback(None)
+        if citation_key not in self._citations:
+            try:
+                self._citations[citation_key] = get_citation_string_and_hyperlink(self.get_entry(citation_key))
+            except CITATION_FORMAT_ERRORS as e:
+                # e.g. single-word institutional authors, or patents without an issue date
+                logging.warning("Could not format the citation of @{}: {!r}".format(citation_key, e))
+                self._format_errors[citation_key] = e
+                raise
+        return self._citations[citation_key]
+
+    def get_markdown_hyperlink(self, citation_key, fig_caption: bool = False):
+        cache_key = (citation_key, fig_caption)
+        if cache_key not in self._hyperlinks:
+            citation_string, hyperlink = self.get_citation(citation_key)
+            self._hyperlinks[cache_key] = format_markdown_hyperlink(citation_string, hyperlink, fig_caption)
+        return self._hyperlinks[cache_key]
+
+    def compile_citations(self):
+        # the missing author/year/URL warnings (and errors) of the whole library are not interesting here,
+        # only for the keys actually cited in the .md files
+        not_compiled = []
+        logging.disable(logging.ERROR)
+        try:
+            for citation_key in self.entries:
+                try:
+                    self.get_citation(citation_key)
+                except CITATION_FORMAT_ERRORS:
+                    # left out of the cache, formatted (and warned about) only if cited
+                    not_compiled.append(citation_key)
+        finally:
+            logging.disable(logging.NOTSET)
+        # formatted again (and warned about) when first cited
+        self._format_errors.clear()
+        if len(not_compiled) > 0:
+            logging.info("{} biblio entries could not be formatted as citations, e.g. @{}".
+                         format(len(not_compiled), not_compiled[0]))
+        return self._citations
 
-    return citation_keys
 
 def import_bibtex_files(input: str, output: str,
-                        parser_method = 'betterbibtex_json'):
+                        parser_method = 'betterbibtex_json',
+                        use_cache: bool = True,
+                        timings: dict = None):
 
     if not os.path.exists(input):
         raise FileNotFoundError("Input bibtex file not found: {}".format(input))
     else:
         logging.info("Found input bibtex file: {}".format(input))
 
-    if parser_method == 'pybtex':
+    fingerprint = get_source_fingerprint(input)
+    cache_path = get_citation_cache_path(input)
+    start_time = time.perf_counter()
+    citations, entries_json = load_citation_cache(cache_path, fingerprint) if use_cache else (None, None)
+
+    if citations is not None:
+        bibtex_in = {}
+    elif parser_method == 'pybtex':
         # loses urls
         parser = bibtex.Parser()
         bibtex_in = parser.parse_file(input)
@@ -101,82 +269,204 @@ def import_bibtex_files(input: str, output: str,
         with open(input, 'r') as f:
             json_data = f.read()
         bibtex_in = json.loads(json_data)
-        bibtex_in['citation_keys'] = get_citation_keys_from_json_dict(bibtex_in)
+    elif parser_method == 'betterbibtex_json_stream':
+        bibtex_in = load_betterbibtex_json_stream(input)
     else:
         raise ValueError("Parser method not recognized: {}".format(parser_method))
 
-    logging.info("Bibtex file with {} biblio entries".format(len(bibtex_in['items'])))
+    if timings is not None:
+        timings['load'] = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+
+    if citations is not None:
+        bibtex_in['citation_index'] = CitationIndex(citations=citations, entries_json=entries_json)
+    else:
+        bibtex_in['citation_index'] = CitationIndex(bibtex_in['items'])
+    bibtex_in['citation_index'].version = fingerprint
+    if use_cache and citations is None:
+        save_citation_cache(cache_path, fingerprint, bibtex_in['citation_index'].compile_citations(),
+                            bibtex_in['citation_index'].get_entries_json())
+
+    if timings is not None:
+        timings['index'] = time.perf_counter() - start_time
+
+    logging.info("Bibtex file with {} biblio entries".format(len(bibtex_in['citation_index'])))
 
     if not os.path.exists(output):
         logging.warning("Output bibtex file not found: {}, creating a new one".format(output))
-        bibtex_out = create_bibtex(bib_path=output)
     else:
         # in this option, you are appending to an existing one
-        bibtex_out = output
+        logging.info("Appending the cited entries to the existing output bibtex file: {}".format(output))
+    bibtex_out = output
 
     return bibtex_in, bibtex_out
 
 
-def process_md_files(md_files: list, bibtex_in, bibtex_out,
-                     write_out: bool = True):
+def read_md_file(md_file: str):
+    with open(md_file, 'r') as f:
+        return f.readlines()
 
-    nonfound_keys = []
-    markdown_links = []
 
-    for md_file in md_files:
-        logging.info("Processing file: {}".format(md_file))
+def transform_md_lines(md_file: str, lines: list, bibtex_in, bibtex_out):
+    start_time = time.perf_counter()
+    md_file_lines_out, markdown_links_per_md, keys_not_matched, caption_keys_not_matched = (
+        convert_md_lines(lines, bibtex_in=bibtex_in, bibtex_out=bibtex_out, md_file=md_file))
+    scan_seconds = time.perf_counter() - start_time
 
-        md_file_lines_out, markdown_links_per_md, keys_not_matched = (
-            convert_md_file(md_file=md_file, bibtex_in=bibtex_in, bibtex_out=bibtex_out))
+    return md_file_lines_out, markdown_links_per_md, keys_not_matched, caption_keys_not_matched, scan_seconds
 
-        nonfound_keys += keys_not_matched
-        markdown_links += markdown_links_per_md
 
-        # write the .md file to disk
-        if write_out:
-            with open(md_file, 'w') as f:
-                logging.info("Writing to file: {}".format(md_file))
-                f.writelines(md_file_lines_out)
-        else:
-            logging.info("DEBUG MODE ON | Not writing to file: {}".format(md_file))
+def write_md_file(md_file: str, lines: list, md_file_lines_out: list, write_out: bool = True):
 
-    return nonfound_keys, markdown_links
+    # write the .md file to disk, only if something was converted
+    start_time = time.perf_counter()
+    bytes_written = 0
+    if md_file_lines_out == lines:
+        logging.info("No changes, not writing to file: {}".format(md_file))
+    elif write_out:
+        logging.info("Writing to file: {}".format(md_file))
+        bytes_written = write_file_if_changed(md_file, ''.join(md_file_lines_out), text_on_disk=''.join(lines))
+    else:
+        logging.info("DEBUG MODE ON | Not writing to file: {}".format(md_file))
 
+    return bytes_written, time.perf_counter() - start_time
 
-def clean_figure_captionm_word(word):
 
-    # common problem now that the citation key is at the end of the field touching ]
-    # e.g. @palmqvistBloodBiomarkersImprove2023](Pasted%20image%2020240429112435
-    word = word.replace('![', '')
-    word_split = word.split(']')
-    if len(word_split) > 1:
-        word = word_split[0]
+def process_md_file(md_file: str, bibtex_in, bibtex_out,
+                    write_out: bool = True):
 
-    return word
+    logging.info("Processing file: {}".format(md_file))
 
+    lines = read_md_file(md_file)
+    md_file_lines_out, markdown_links_per_md, keys_not_matched, caption_keys_not_matched, scan_seconds = (
+        transform_md_lines(md_file, lines, bibtex_in, bibtex_out))
+    bytes_written, write_seconds = write_md_file(md_file, lines, md_file_lines_out, write_out=write_out)
 
-def process_figure_field(line, bibtex_in):
+    file_report = create_file_report(md_file, markdown_links_per_md, keys_not_matched, caption_keys_not_matched,
+                                     bytes_written=bytes_written, scan_seconds=scan_seconds,
+                                     write_seconds=write_seconds)
+
+    return markdown_links_per_md, file_report
+
+
+# Read-only state of the worker processes. With the "fork" start method (Linux default), the citation index
+# passed as initargs is inherited copy-on-write instead of being pickled to every worker
+_worker_state = {}
+
+
+def init_md_file_worker(bibtex_in, bibtex_out, write_out: bool):
+    _worker_state['bibtex_in'] = bibtex_in
+    _worker_state['bibtex_out'] = bibtex_out
+    _worker_state['write_out'] = write_out
 
-    # You cannot have []() type of links inside the alt text field (at least in Obsidian, the figure is not
-    # rendered correctly anymore
-    # Quick fix then to display the name (year), and link on the caption (separately)
 
-    line_out = line
-    words = line.split(' ')
+def process_md_file_in_worker(md_file: str):
+    return process_md_file(md_file, **_worker_state)
 
-    key_match = []
-    key_not_founds = []
 
-    for word in words:
-        if word.startswith('@'):
-            word = clean_figure_captionm_word(word)
-            markdown_hyperlink, extra_suffix, key_found, key_not_found = (
-                convert_citation(word=word, bibtex_in=bibtex_in, fig_caption=True))
-            if markdown_hyperlink is not None:
-                line_out = line_out.replace(word, markdown_hyperlink)
-                key_match.append((markdown_hyperlink, key_found))
+def transform_md_lines_in_worker(md_file: str, lines: list):
+    return transform_md_lines(md_file, lines, _worker_state['bibtex_in'], _worker_state['bibtex_out'])
+
+
+def process_md_files_pipelined(md_files: list, bibtex_in, bibtex_out,
+                               write_out: bool = True, jobs: int = 1, io_threads: int = 8):
+    """
+    read -> transform -> write pipeline for slow (network, synced) filesystems: a reader thread pool prefetches
+    the files, the transform runs in this process (or in "jobs" worker processes), and a writer thread pool writes
+    the converted files. Each stage has at most queue_size files in flight, so the memory use stays bounded, and
+    the results are collected in the input order
+    """
+    queue_size = io_threads * 4
+    md_files_iter = iter(md_files)
+    reading, converting, writing = deque(), deque(), deque()
+    results = []
+
+    if jobs > 1:
+        transform_executor = ProcessPoolExecutor(jobs, initializer=init_md_file_worker,
+                                                 initargs=(bibtex_in, bibtex_out, write_out))
+    else:
+        # the transform runs in this process, i.e. transform_pool is None
+        transform_executor = nullcontext()
+
+    # shut down with the thread pools, also if any of the stages raises
+    with transform_executor as transform_pool, \
+            ThreadPoolExecutor(io_threads, thread_name_prefix='md_reader') as readers, \
+            ThreadPoolExecutor(io_threads, thread_name_prefix='md_writer') as writers:
+
+        def submit_transform(md_file, lines):
+            if transform_pool is not None:
+                return transform_pool.submit(transform_md_lines_in_worker, md_file, lines)
+            future = Future()
+            future.set_result(transform_md_lines(md_file, lines, bibtex_in, bibtex_out))
+            return future
+
+        def start_reading():
+            for md_file in itertools.islice(md_files_iter, queue_size - len(reading)):
+                reading.append((md_file, readers.submit(read_md_file, md_file)))
+
+        start_reading()
+        while reading or converting or writing:
+            if reading and len(converting) < queue_size:
+                md_file, read_future = reading.popleft()
+                logging.info("Processing file: {}".format(md_file))
+                lines = read_future.result()
+                start_reading()
+                converting.append((md_file, lines, submit_transform(md_file, lines)))
+
+            elif converting and len(writing) < queue_size:
+                md_file, lines, transform_future = converting.popleft()
+                md_file_lines_out, *transform_results = transform_future.result()
+                write_future = writers.submit(write_md_file, md_file, lines, md_file_lines_out, write_out)
+                writing.append((md_file, transform_results, write_future))
+
             else:
-                key_not_founds.append(key_not_found)
+                md_file, (markdown_links_per_md, keys_not_matched, caption_keys_not_matched, scan_seconds), \
+                    write_future = writing.popleft()
+                bytes_written, write_seconds = write_future.result()
+                results.append((markdown_links_per_md,
+                                create_file_report(md_file, markdown_links_per_md, keys_not_matched,
+                                                   caption_keys_not_matched, bytes_written=bytes_written,
+                                                   scan_seconds=scan_seconds, write_seconds=write_seconds)))
+
+    return results
+
+
+def process_md_files(md_files: list, bibtex_in, bibtex_out,
+                     write_out: bool = True, jobs: int = 1, io_threads: int = 0):
+
+    nonfound_keys = []
+    markdown_links = []
+    file_reports = []
+
+    if io_threads > 0:
+        logging.info("Converting {} .md files with {} I/O threads and {} transform process(es)".
+                     format(len(md_files), io_threads, jobs))
+        results = process_md_files_pipelined(md_files, bibtex_in, bibtex_out, write_out=write_out,
+                                             jobs=jobs, io_threads=io_threads)
+    elif jobs > 1 and len(md_files) > 1:
+        logging.info("Converting {} .md files with {} worker processes".format(len(md_files), jobs))
+        chunksize = max(1, len(md_files) // (jobs * 8))
+        with multiprocessing.Pool(jobs, initializer=init_md_file_worker,
+                                  initargs=(bibtex_in, bibtex_out, write_out)) as pool:
+            # imap() returns the results in the input order, so the merged reports match the serial run
+            results = list(pool.imap(process_md_file_in_worker, md_files, chunksize=chunksize))
+    else:
+        results = (process_md_file(md_file, bibtex_in, bibtex_out, write_out=write_out) for md_file in md_files)
+
+    for markdown_links_per_md, file_report in results:
+        nonfound_keys += file_report['keys_not_found']
+        markdown_links += markdown_links_per_md
+        file_reports.append(file_report)
+
+    return nonfound_keys, markdown_links, file_reports
+
+
+def process_figure_field(line, bibtex_in):
+
+    # You cannot have []() type of links inside the alt text field (at least in Obsidian, the figure is not
+    # rendered correctly anymore
+    # Quick fix then to display the name (year), and link on the caption (separately)
+    line_out, key_match, key_not_founds = substitute_citations(line, bibtex_in, fig_caption=True)
 
     return line_out, key_match, key_not_founds
 
@@ -271,7 +561,7 @@ def get_year(entry):
     return date
 
 
-def get_hardcoded_citation_from_entry(entry, bibtex_out, fig_caption: bool = False):
+def get_citation_string_and_hyperlink(entry):
 
     name = get_author_naming(entry)
     year = get_year(entry)
@@ -280,6 +570,11 @@ def get_hardcoded_citation_from_entry(entry, bibtex_out, fig_caption: bool = Fal
     # hyperlink to the article
     hyperlink = get_article_hyperlink(entry)
 
+    return citation_string, hyperlink
+
+
+def format_markdown_hyperlink(citation_string, hyperlink, fig_caption: bool = False):
+
     # markdown hyperlink
     if hyperlink is not None:
         if fig_caption:
@@ -292,109 +587,92 @@ def get_hardcoded_citation_from_entry(entry, bibtex_out, fig_caption: bool = Fal
     return markdown_hyperlink
 
 
-def clean_text_key(word):
-
-    word_out = word.replace('@', '')
-
-    # the citation might not be followed by a whitespace
-    word_out = word_out.split(')')[0]
-    word_out = word_out.split(';')[0]
-    word_out = word_out.split(',')[0]
-    word_out = word_out.split('.')[0]
-    word_out = word_out.split('?')[0]
-    word_out = word_out.split(':')[0]
-    word_out = word_out.split('\n')[0]
-    word_out = word_out.rstrip()
+# "@citationKey" that is not preceded by a word character or "/" (e.g. e-mail addresses, or the "@user" of
+# https://medium.com/@user/post-1 and Mastodon links), so that "(@key", "[@key" and "![@key" (figure alt text,
+# group "figure") are caught as well. The key ends at whitespace, at "/" or at the punctuation that typically
+# follows a citation, e.g. "(@key1; @key2)", "@key.", "[@key]"
+CITATION_KEY_PATTERN = re.compile(r'(?P<figure>!\[)?(?<![\w@/])@(?P<key>[^\s@()\[\]{}<>;,.?:!*`\'"/]+)')
 
-    # if 'huangGlymphaticSystemDysf' in word:
-    #     word = 11
 
-    return word_out
+def convert_citation(text_key, bibtex_in, fig_caption:bool = False):
 
+    citation_index = bibtex_in['citation_index']
 
-def convert_citation(word, bibtex_in, fig_caption:bool = False):
-
-    db_keys_list = bibtex_in['citation_keys'] # list(bibtex_in.entries_dict.keys())
-    text_key = clean_text_key(word)
-
-    extra_suffix = None
-    if '@'+text_key != word:
-        # extra crap after the citation key, e.g ", ", or ")", or ";"
-        extra_suffix = word.split('@'+text_key)[1]
+    if text_key in citation_index:
+        try:
+            markdown_hyperlink = citation_index.get_markdown_hyperlink(text_key, fig_caption)
+            key_found = text_key
+            key_not_found = None
+        except CITATION_FORMAT_ERRORS:
+            # already warned about by the citation index, once per key
+            markdown_hyperlink, key_found = None, None
+            key_not_found = text_key
 
-    try:
-        entry_index = db_keys_list.index(text_key)
-        entry = bibtex_in['items'][entry_index]
-        markdown_hyperlink = get_hardcoded_citation_from_entry(entry, bibtex_in, fig_caption)
-        key_found = bibtex_in['citation_keys'][entry_index]
-        key_not_found = None
-
-    except ValueError:
-        entry_index, markdown_hyperlink, key_found = None, None, None
+    else:
+        markdown_hyperlink, key_found = None, None
         key_not_found = text_key
         logging.warning("Key not found in bibtex: @{}".format(text_key))
 
-    return markdown_hyperlink, extra_suffix, key_found, key_not_found
-
-def process_text_line(line, line_tmp, bibtex_in, bibtex_out):
+    return markdown_hyperlink, key_found, key_not_found
 
-    # if 'huangGlymphaticSystemDysf' in line:
-    #     print('here')
 
-    # There might be extra spaces, e.g. ( @citationKey) that could be converted to (@citationKey)
+def substitute_citations(text, bibtex_in, fig_caption: bool = False):
+    """
+    Single regex pass over the text, the found citation keys are replaced with the hardcoded hyperlinks
+    and the output is assembled with one join (instead of concatenating word by word)
+    """
 
-    line_out = ''
-    words = line.split(' ')
-    keys_not_found = []
+    parts = []
     markdown_hyperlinks = []
+    keys_not_found = []
+    last_end = 0
 
-    for word in words:
-
-        key_found, key_not_found = None, None
-        if word.startswith('@'):
-            markdown_hyperlink, extra_suffix, key_found, key_not_found = convert_citation(word, bibtex_in)
+    for match in CITATION_KEY_PATTERN.finditer(text):
+        as_caption = fig_caption or match.group('figure') is not None
+        markdown_hyperlink, key_found, key_not_found = (
+            convert_citation(match.group('key'), bibtex_in, fig_caption=as_caption))
 
-            if markdown_hyperlink is not None:
-                markdown_tuple = (key_found, markdown_hyperlink)
-                markdown_hyperlinks.append(markdown_tuple)
+        if markdown_hyperlink is not None:
+            # keep the possible "![" in front of the "@"
+            key_start = match.start('key') - 1
+            parts.append(text[last_end:key_start])
+            parts.append(markdown_hyperlink)
+            last_end = match.end()
+            markdown_hyperlinks.append((key_found, markdown_hyperlink))
+        elif key_not_found is not None:
+            # None for the keys that were found but have no URL/DOI to link to
+            keys_not_found.append(key_not_found)
 
-                if extra_suffix is not None:
-                    word_out = markdown_hyperlink + extra_suffix
-                else:
-                    word_out = markdown_hyperlink
+    parts.append(text[last_end:])
 
-                word = word_out
+    return ''.join(parts), markdown_hyperlinks, keys_not_found
 
-            if key_not_found is not None:
-                keys_not_found.append(key_not_found)
 
-        elif word.startswith('![@'):
-            # you have a figure caption with a citation key here not caught by initial check,
-            # e.g. when your word is the 4th or something on the line with empty entries
-            # ['>', '', '', '![@palmqvistBloodBiomarkersImprove2023](Pasted%20image%2020240429112435.png)\n']
-            word, key_match, key_not_founds = process_figure_field(word, bibtex_in)
+def process_text_line(line, line_tmp, bibtex_in, bibtex_out):
 
-
-        if line_out == '':
-            # the first word
-            line_out += word
-        else:
-            # rest of the words of the line
-            line_out += ' ' + word
+    # Figure captions not caught by the initial check (e.g. "> ![@key](Pasted%20image.png)" after some
+    # text on the same line) are converted as figure captions by the "figure" group of the pattern
+    line_out, markdown_hyperlinks, keys_not_found = substitute_citations(line, bibtex_in)
 
     return line_out, markdown_hyperlinks, keys_not_found
 
 
 def convert_md_file(md_file, bibtex_in, bibtex_out):
 
-    no_figure_captions = 0
-
     with open(md_file, 'r') as f:
         lines = f.readlines()
 
+    return convert_md_lines(lines, bibtex_in, bibtex_out, md_file=md_file)
+
+
+def convert_md_lines(lines, bibtex_in, bibtex_out, md_file: str = ''):
+
+    no_figure_captions = 0
+
     lines_out = []
     keys_matched = []
     keys_not_matched = []
+    caption_keys_not_matched = []
     markdown_links = []
 
     for line in lines:
@@ -409,6 +687,8 @@ def convert_md_file(md_file, bibtex_in, bibtex_out):
         if line_tmp.startswith('!['):
             no_figure_captions += 1
             line, key_match, key_not_founds = process_figure_caption(line, line_tmp, bibtex_in, bibtex_out)
+            markdown_links += key_match
+            caption_keys_not_matched += key_not_founds
 
         else:
             # process the text
@@ -427,28 +707,47 @@ def convert_md_file(md_file, bibtex_in, bibtex_out):
     logging.debug("Found {} figure captions and {} text citations in {}".
                  format(no_figure_captions, len(markdown_links), md_file))
 
-    return lines_out, markdown_links, keys_not_matched
+    return lines_out, markdown_links, keys_not_matched, caption_keys_not_matched
 
 
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
     args = parse_args_to_dict()
+    timings = {}
+    run_start_time = time.perf_counter()
 
     md_files = list_md_files_in_dir(args['md_files_dir'])
 
     bibtex_in, bibtex_out = (
         import_bibtex_files(input=args['input_bibtex_file'],
-                            output=args['output_bibtex_file'])
+                            output=args['output_bibtex_file'],
+                            parser_method=args['parser_method'],
+                            use_cache=not args['no_cache'],
+                            timings=timings)
     )
 
-    nonfound_keys, markdown_links = (
-        process_md_files(md_files=md_files, bibtex_in=bibtex_in, bibtex_out=bibtex_out))
+    # only convert the new/modified notes
+    bibtex_version = bibtex_in['citation_index'].version
+    manifest_path = get_manifest_path(args['md_files_dir'])
+    manifest = load_manifest(manifest_path)
+    if not args['full']:
+        md_files = filter_changed_md_files(md_files, manifest, args['md_files_dir'], bibtex_version)
+
+    nonfound_keys, markdown_links, file_reports = (
+        process_md_files(md_files=md_files, bibtex_in=bibtex_in, bibtex_out=bibtex_out,
+                         jobs=args['jobs'], io_threads=args['io_threads']))
+
+    update_manifest(manifest, md_files, args['md_files_dir'], bibtex_version)
+    save_manifest(manifest_path, manifest)
+
+    create_bibtex(bib_path=bibtex_out, bibtex_in=bibtex_in, markdown_links=markdown_links)
 
-    # TODO! does not include key errors in figure captions, atm see the debug printouts during processing
-    logging.info("Keys not found from body text:")
-    for key in nonfound_keys:
-        logging.warning(" @{}".format(key))
-    logging.info("Markdown link conversion (tuples):\n {}".format(markdown_links))
+    report = build_run_report(file_reports, markdown_links, timings,
+                              total_seconds=time.perf_counter() - run_start_time)
+    log_run_report(report)
+    if args['report_file'] is not None:
+        save_run_report(args['report_file'], report)
+    logging.debug("Markdown link conversion (tuples):\n {}".format(markdown_links))
 
     logging.info("Conversion done!")
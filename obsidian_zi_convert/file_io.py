@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+
+def write_file_atomic(file_path: str, text: str):
+    """
+    Write to a temp file in the same folder and rename it over the original, so that a crash mid-write
+    cannot leave a truncated note behind. Returns the number of bytes written
+    """
+    dir_name, base_name = os.path.split(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.' + base_name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+            bytes_written = os.fstat(f.fileno()).st_size
+        if os.path.exists(file_path):
+            # keep the permissions of the original file (mkstemp creates the file as 0600)
+            os.chmod(tmp_path, os.stat(file_path).st_mode & 0o7777)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return bytes_written
+
+
+def write_file_if_changed(file_path: str, text: str, text_on_disk: str = None):
+    """
+    Returns the number of bytes written, 0 if the file already had the same content
+    (i.e. the file is not touched, and e.g. Dropbox does not re-upload it)
+    """
+    if text_on_disk is None and os.path.exists(file_path):
+        with open(file_path, 'r') as f:
+            text_on_disk = f.read()
+
+    if text == text_on_disk:
+        return 0
+
+    return write_file_atomic(file_path, text)
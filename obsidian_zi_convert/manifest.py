@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import os
+
+MANIFEST_FILENAME = '.zi_convert_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(md_files_dir: str):
+    return os.path.join(md_files_dir, MANIFEST_FILENAME)
+
+
+def hash_content(data: bytes):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def get_file_signature(md_file: str):
+    with open(md_file, 'rb') as f:
+        data = f.read()
+    stat = os.stat(md_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hash_content(data)}
+
+
+def load_manifest(manifest_path: str):
+    """
+    Manifest of the already converted .md files: {relative path: {size, mtime_ns, hash}}, and
+    the version (fingerprint) of the biblio export that they were converted with
+    """
+    empty_manifest = {'version': MANIFEST_VERSION, 'bibtex_version': None, 'files': {}}
+    if not os.path.exists(manifest_path):
+        logging.info("No conversion manifest found, converting all the .md files")
+        return empty_manifest
+
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read the conversion manifest {}, converting all the .md files: {}".
+                        format(manifest_path, e))
+        return empty_manifest
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        logging.info("Conversion manifest is from an older version, converting all the .md files")
+        return empty_manifest
+
+    return manifest
+
+
+def save_manifest(manifest_path: str, manifest: dict):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_manifest_key(md_file: str, md_files_dir: str):
+    return os.path.relpath(md_file, md_files_dir)
+
+
+def filter_changed_md_files(md_files: list, manifest: dict, md_files_dir: str, bibtex_version: str):
+    """
+    Returns the .md files that are new or modified since the previous run. If the biblio export changed,
+    every file needs to be converted again, as previously missing keys might be found now
+    """
+    # forget the notes that have been deleted/renamed since
+    md_file_keys = {get_manifest_key(md_file, md_files_dir) for md_file in md_files}
+    manifest['files'] = {key: record for key, record in manifest['files'].items() if key in md_file_keys}
+
+    if manifest['bibtex_version'] != bibtex_version:
+        if manifest['bibtex_version'] is not None:
+            logging.info("Input bibtex file changed since the previous run, converting all the .md files")
+        return list(md_files)
+
+    changed_files = []
+    for md_file in md_files:
+        record = manifest['files'].get(get_manifest_key(md_file, md_files_dir))
+        if record is None:
+            changed_files.append(md_file)
+            continue
+
+        stat = os.stat(md_file)
+        if stat.st_size == record['size'] and stat.st_mtime_ns == record['mtime_ns']:
+            continue
+
+        # touched (e.g. by a sync client) but not necessarily modified
+        signature = get_file_signature(md_file)
+        if signature['hash'] == record['hash']:
+            record['mtime_ns'] = signature['mtime_ns']
+        else:
+            changed_files.append(md_file)
+
+    logging.info("{}/{} .md files are new or modified since the previous run".
+                 format(len(changed_files), len(md_files)))
+
+    return changed_files
+
+
+def update_manifest(manifest: dict, md_files: list, md_files_dir: str, bibtex_version: str):
+
+    manifest['bibtex_version'] = bibtex_version
+    for md_file in md_files:
+        manifest['files'][get_manifest_key(md_file, md_files_dir)] = get_file_signature(md_file)
+
+    return manifest
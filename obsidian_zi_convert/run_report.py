@@ -0,0 +1,103 @@
+import csv
+import json
+import logging
+from collections import Counter
+
+from file_io import write_file_atomic
+
+
+def create_file_report(md_file: str, markdown_links: list, keys_not_found: list, caption_keys_not_found: list,
+                       bytes_written: int, scan_seconds: float, write_seconds: float):
+    return {
+        'md_file': md_file,
+        'citations': len(markdown_links),
+        'keys_not_found': keys_not_found,
+        'caption_keys_not_found': caption_keys_not_found,
+        'bytes_written': bytes_written,
+        'scan_seconds': scan_seconds,
+        'write_seconds': write_seconds,
+    }
+
+
+def build_run_report(file_reports: list, markdown_links: list, timings: dict, total_seconds: float):
+    """
+    Note! With --jobs N, the "scan" and "write" timings are summed over the worker processes,
+    i.e. they can be larger than the total (wall clock) time of the run
+    """
+    key_hits = Counter(key for key, _ in markdown_links)
+    keys_not_found = Counter(key for file_report in file_reports for key in file_report['keys_not_found'])
+    caption_keys_not_found = Counter(key for file_report in file_reports
+                                     for key in file_report['caption_keys_not_found'])
+    files_written = [file_report for file_report in file_reports if file_report['bytes_written'] > 0]
+
+    timings = dict(timings)
+    timings['scan'] = sum(file_report['scan_seconds'] for file_report in file_reports)
+    timings['write'] = sum(file_report['write_seconds'] for file_report in file_reports)
+    timings['total'] = total_seconds
+
+    return {
+        'summary': {
+            'files_processed': len(file_reports),
+            'files_written': len(files_written),
+            'files_skipped': len(file_reports) - len(files_written),
+            'bytes_written': sum(file_report['bytes_written'] for file_report in files_written),
+            'citations_converted': len(markdown_links),
+            'unique_keys_converted': len(key_hits),
+            'keys_not_found': sum(keys_not_found.values()),
+            'caption_keys_not_found': sum(caption_keys_not_found.values()),
+        },
+        'timings': timings,
+        'key_hits': dict(key_hits.most_common()),
+        'keys_not_found': dict(keys_not_found.most_common()),
+        'caption_keys_not_found': dict(caption_keys_not_found.most_common()),
+        'files': file_reports,
+    }
+
+
+def log_run_report(report: dict):
+
+    if len(report['keys_not_found']) > 0:
+        logging.info("Keys not found from body text:")
+        for key, count in report['keys_not_found'].items():
+            logging.warning(" @{} ({}x)".format(key, count))
+    if len(report['caption_keys_not_found']) > 0:
+        logging.info("Keys not found from figure captions:")
+        for key, count in report['caption_keys_not_found'].items():
+            logging.warning(" @{} ({}x)".format(key, count))
+
+    summary = report['summary']
+    logging.info("Converted {} citations ({} unique keys) in {} .md files".
+                 format(summary['citations_converted'], summary['unique_keys_converted'], summary['files_processed']))
+    logging.info("Wrote {} .md files ({:.1f} kB), {} files without changes were not touched".
+                 format(summary['files_written'], summary['bytes_written'] / 10 ** 3, summary['files_skipped']))
+    logging.info("Timings: {}".format(', '.join('{} {:.2f} s'.format(phase, seconds)
+                                               for phase, seconds in report['timings'].items())))
+
+
+def get_report_csv_rows(report: dict):
+    # "long" format, so that the rows of different runs can be concatenated and compared
+    rows = [('summary', '', name, value) for name, value in report['summary'].items()]
+    rows += [('timing', phase, 'seconds', seconds) for phase, seconds in report['timings'].items()]
+    rows += [('key', key, 'hits', count) for key, count in report['key_hits'].items()]
+    rows += [('key_not_found', key, 'text', count) for key, count in report['keys_not_found'].items()]
+    rows += [('key_not_found', key, 'caption', count) for key, count in report['caption_keys_not_found'].items()]
+    for file_report in report['files']:
+        for name in ('citations', 'bytes_written', 'scan_seconds', 'write_seconds'):
+            rows.append(('file', file_report['md_file'], name, file_report[name]))
+        rows.append(('file', file_report['md_file'], 'keys_not_found', len(file_report['keys_not_found'])))
+        rows.append(('file', file_report['md_file'], 'caption_keys_not_found',
+                     len(file_report['caption_keys_not_found'])))
+    return rows
+
+
+def save_run_report(report_path: str, report: dict):
+
+    if report_path.endswith('.csv'):
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('section', 'name', 'metric', 'value'))
+            writer.writerows(get_report_csv_rows(report))
+    else:
+        write_file_atomic(report_path, json.dumps(report, indent=2))
+
+    logging.info("Saved the run report to {}".format(report_path))
@@ -6,7 +6,7 @@ import re
 from PIL import Image
 
 from remove_unused_figures import get_disk_use
-from utils import get_image_refs_of_line, get_absolute_img_path
+from utils import get_image_refs_of_line, get_absolute_img_path, build_basename_index
 
 
 def parse_args_to_dict():
@@ -51,6 +51,7 @@ def get_all_img_files(input_folder):
 def process_md_files_for_optimization(input_folder, export_on = True):
 
     img_files = get_all_img_files(input_folder)
+    basename_index = build_basename_index(img_files)
     md_files = sorted(glob.glob(os.path.join(input_folder, '**', '*.md'), recursive=True))
     for i, md_file in enumerate(md_files):
 
@@ -61,7 +62,7 @@ def process_md_files_for_optimization(input_folder, export_on = True):
         if 'Computational Art' in md_file:
             print('debug')
 
-        lines_out, lines_changed = optimize_imgs_references(lines, img_files)
+        lines_out, lines_changed = optimize_imgs_references(lines, basename_index, md_file)
 
         if export_on:
             if len(lines_changed) > 0:
@@ -75,13 +76,13 @@ def process_md_files_for_optimization(input_folder, export_on = True):
     img_size_out, not_found = get_disk_use(img_files_out)
 
 
-def optimize_imgs_references(lines, img_files):
+def optimize_imgs_references(lines, basename_index, md_file):
 
     lines_changed = []
     lines_out = []
     for i, line in enumerate(lines):
         if '![' in line:
-            line, image_path_out = process_line_for_img_optimization(line, img_files)
+            line, image_path_out = process_line_for_img_optimization(line, basename_index, md_file)
             if image_path_out is not None:
                 lines_changed.append((i, line, image_path_out))
         lines_out.append(line)
@@ -195,14 +196,14 @@ def process_single_imagepath(image_path_list, line, ref, not_reduced):
     return line, not_reduced, image_path_out
 
 
-def process_line_for_img_optimization(line, img_files):
+def process_line_for_img_optimization(line, basename_index, md_file):
 
     refs = get_image_refs_of_line(line)
     not_reduced = []
     image_path_out = None
 
     for ref in refs:
-        image_path_list = get_absolute_img_path(ref, img_files)
+        image_path_list = get_absolute_img_path(ref, basename_index, md_file)
         if image_path_list is not None:
             # you might have had non-unique filenames, so you might have multiple matches
             # especially happening if you import from Google Docs
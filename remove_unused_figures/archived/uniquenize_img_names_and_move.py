@@ -7,6 +7,7 @@ import re
 import time
 from copy import deepcopy
 
+from find_duplicate_images import files_have_same_content
 from remove_unused_figures import get_kb_files, get_img_refs_from_md_files
 
 
@@ -163,8 +164,8 @@ def check_if_existing_image_is_the_same(in_path, out_path):
     debug_dict['in_path'] = in_path
     debug_dict['out_path'] = out_path
 
-    if debug_dict['in_size'] == debug_dict['out_size']:
-        # This should be the same file if the sizes are the same
+    if files_have_same_content(in_path, out_path):
+        # Same size is not enough (e.g. screenshots of the same window), compare the content as well
         return None, None
     else:
         hashlib.sha1().update(str(time.time()).encode("utf-8"))
@@ -280,9 +281,7 @@ if __name__ == "__main__":
     logging.info(f"Processing {len(md_files)} .md files.")
     for i, md_file in enumerate(md_files):
         logging.info(f"Processing {i+1}/{len(md_files)}: {md_file}")
-        fname = os.path.basename(md_file)
-        fname, ext = os.path.splitext(fname)
-        im_refs_file = img_refs[fname.replace(' ', '_')]
+        im_refs_file = img_refs[md_file]
 
         with open(md_file, 'r') as f:
             lines = f.readlines()
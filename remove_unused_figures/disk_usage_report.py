@@ -0,0 +1,214 @@
+import argparse
+import json
+import logging
+import os
+
+from utils import (IMAGE_EXTENSIONS, scan_vault, get_inventory_files, get_move_folders, is_in_folder,
+                   build_reference_index, find_unreferenced_files)
+from remove_unused_figures import get_disk_use, get_img_refs_from_md_files
+from find_duplicate_images import find_duplicate_files
+from encoder_policy import ESTIMATED_SIZE_RATIOS
+
+# the same rough estimate as in the conversion plan of optimize_imgs_v2.py
+PNG_TO_JPEG_RATIO = ESTIMATED_SIZE_RATIOS['PNG']
+
+
+def parse_args_to_dict():
+
+    parser = argparse.ArgumentParser(
+        description="Where does the disk space of the knowledge base go? Sizes per file type and folder, "
+                    "largest attachments, unreferenced and duplicate images."
+    )
+    parser.add_argument(
+        "-i",
+        "--input-folder",
+        type=str,
+        required=True,
+        default="/home/petteri/Dropbox/KnowledgeBase",
+        help="Knowledge base folder.",
+    )
+    parser.add_argument(
+        "-index",
+        "--reference-index",
+        type=str,
+        required=False,
+        default=None,
+        help="SQLite reference index for finding the unreferenced images (see remove_unused_figures.py)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of processes for reading the image references from the .md files",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        required=False,
+        default=20,
+        help="Number of the largest attachments to list",
+    )
+    parser.add_argument(
+        "--folder-depth",
+        type=int,
+        required=False,
+        default=1,
+        help="Folder levels (below the input folder) to sum the sizes to",
+    )
+    parser.add_argument(
+        "--duplicates",
+        action="store_true",
+        help="Hash the images to find the duplicates (reads the same-sized images, slower)",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        required=False,
+        default="table",
+        choices=["table", "json"],
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=False,
+        default=None,
+        help="Write the report to this file instead of printing it",
+    )
+    args_dict = vars(parser.parse_args())
+
+    return args_dict
+
+
+def get_folder_key(path: str, input_folder: str, depth: int = 1):
+    parts = os.path.relpath(os.path.dirname(path), input_folder).split(os.path.sep)
+    if parts == ['.']:
+        return '.'
+    return '/'.join(parts[:depth])
+
+
+def sum_sizes_by(vault_files: list, key):
+
+    histogram = {}
+    for f in vault_files:
+        entry = histogram.setdefault(key(f), {'files': 0, 'bytes': 0})
+        entry['files'] += 1
+        entry['bytes'] += f.size
+
+    return dict(sorted(histogram.items(), key=lambda item: item[1]['bytes'], reverse=True))
+
+
+def build_disk_usage_report(inventory: dict, input_folder: str, orphan_files: list = None,
+                            duplicates: list = None, top_n: int = 20, folder_depth: int = 1):
+    """
+    Everything from the sizes of the scan_vault() inventory, i.e. without any further stat() calls
+    """
+    all_files = [f for files in inventory.values() for f in files]
+    img_files = get_inventory_files(inventory, IMAGE_EXTENSIONS)
+    sizes = {f.path: f.size for f in img_files}
+    total_size, _ = get_disk_use(all_files)
+    img_size, _ = get_disk_use(img_files)
+
+    png_files = get_inventory_files(inventory, ['.png'])
+    png_size, _ = get_disk_use(png_files)
+
+    report = {
+        'summary': {
+            'files': len(all_files),
+            'bytes': total_size,
+            'image_files': len(img_files),
+            'image_bytes': img_size,
+        },
+        'by_extension': sum_sizes_by(all_files, key=lambda f: os.path.splitext(f.path)[1].lower() or '(none)'),
+        'by_folder': sum_sizes_by(all_files, key=lambda f: get_folder_key(f.path, input_folder, folder_depth)),
+        'largest_attachments': [{'path': f.path, 'bytes': f.size}
+                                for f in sorted(img_files, key=lambda f: f.size, reverse=True)[:top_n]],
+        'png_to_jpeg': {
+            'files': len(png_files),
+            'bytes': png_size,
+            'projected_bytes': int(png_size * PNG_TO_JPEG_RATIO),
+            'projected_savings': png_size - int(png_size * PNG_TO_JPEG_RATIO),
+        },
+    }
+
+    if orphan_files is not None:
+        report['orphans'] = {'files': len(orphan_files), 'bytes': sum(sizes[f] for f in orphan_files)}
+    if duplicates is not None:
+        report['duplicates'] = {'groups': len(duplicates),
+                                'files': sum(len(group) - 1 for group in duplicates),
+                                'bytes': sum(sizes[group[0]] * (len(group) - 1) for group in duplicates)}
+
+    return report
+
+
+def format_size(n_bytes: int):
+    for unit in ('B', 'kB', 'MB'):
+        if n_bytes < 1000:
+            return f'{n_bytes:.0f} {unit}' if unit == 'B' else f'{n_bytes:.1f} {unit}'
+        n_bytes /= 1000
+    return f'{n_bytes:.2f} GB'
+
+
+def format_report_table(report: dict):
+
+    lines = [f"{report['summary']['files']} files, {format_size(report['summary']['bytes'])} "
+             f"({report['summary']['image_files']} images, {format_size(report['summary']['image_bytes'])})", '']
+
+    for title, section in (('Extension', report['by_extension']), ('Folder', report['by_folder'])):
+        width = max([len(title)] + [len(name) for name in section])
+        lines.append(f"{title:<{width}}  {'files':>8}  {'size':>10}")
+        for name, entry in section.items():
+            lines.append(f"{name:<{width}}  {entry['files']:>8}  {format_size(entry['bytes']):>10}")
+        lines.append('')
+
+    lines.append(f"Largest {len(report['largest_attachments'])} attachments:")
+    for entry in report['largest_attachments']:
+        lines.append(f"{format_size(entry['bytes']):>10}  {entry['path']}")
+    lines.append('')
+
+    if 'orphans' in report:
+        lines.append(f"Unreferenced images: {report['orphans']['files']} files, "
+                     f"{format_size(report['orphans']['bytes'])}")
+    if 'duplicates' in report:
+        lines.append(f"Duplicate images: {report['duplicates']['files']} extra copies in "
+                     f"{report['duplicates']['groups']} groups, {format_size(report['duplicates']['bytes'])}")
+    png = report['png_to_jpeg']
+    lines.append(f"PNG -> JPEG (estimate): {png['files']} files, {format_size(png['bytes'])} -> "
+                 f"{format_size(png['projected_bytes'])}, saving ~{format_size(png['projected_savings'])}")
+
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args_to_dict()
+
+    inventory = scan_vault(args["input_folder"])
+    md_files = [f.path for f in get_inventory_files(inventory, ['.md'])]
+    img_files = get_inventory_files(inventory, IMAGE_EXTENSIONS)
+
+    img_refs = get_img_refs_from_md_files(md_files, args["input_folder"], index_path=args["reference_index"],
+                                          jobs=args["jobs"])
+    # the files already moved away count to the sizes, but are not orphans or duplicates to reclaim anymore
+    move_folders = get_move_folders(args["input_folder"])
+    vault_img_files = [f for f in img_files if not any(is_in_folder(f.path, folder) for folder in move_folders)]
+    orphan_files = find_unreferenced_files([f.path for f in vault_img_files], build_reference_index(img_refs))
+    duplicates = find_duplicate_files(vault_img_files) if args["duplicates"] else None
+
+    report = build_disk_usage_report(inventory, args["input_folder"], orphan_files=orphan_files,
+                                     duplicates=duplicates, top_n=args["top"], folder_depth=args["folder_depth"])
+    if args["format"] == "json":
+        text = json.dumps(report, indent=2) + '\n'
+    else:
+        text = format_report_table(report)
+
+    if args["output"] is not None:
+        with open(args["output"], 'w') as f:
+            f.write(text)
+        logging.info(f"Saved the disk usage report to {args['output']}")
+    else:
+        print(text, end='')
@@ -0,0 +1,128 @@
+import math
+import os
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat, features
+
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+
+def get_supported_formats(formats):
+    # WebP only if Pillow was built with it, otherwise every image would fail to encode
+    return tuple(fmt for fmt in formats if fmt != 'WEBP' or features.check('webp'))
+
+
+DEFAULT_FORMATS = get_supported_formats(('JPEG', 'PNG', 'WEBP'))
+
+# min_psnr (dB) is the quality threshold for the lossy candidates, images smaller than min_bytes are left
+# as they are, and images larger than max_dimension (px, longer side) are downscaled
+EncoderPolicy = namedtuple('EncoderPolicy',
+                           ['formats', 'jpeg_quality', 'webp_quality', 'subsampling', 'min_psnr', 'min_bytes',
+                            'max_dimension'],
+                           defaults=[DEFAULT_FORMATS, 85, 85, 0, 40.0, 100 * 10 ** 3, 2560])
+
+# Rough output / input size ratios for the estimates of the conversion plan, only the trial encodings tell
+# the real sizes. E.g. screenshot PNGs shrink to about a third as JPEG/WebP
+ESTIMATED_SIZE_RATIOS = {'PNG': 0.3, 'JPEG': 0.8}
+# no JPEG for the images with alpha, so less savings
+ALPHA_SIZE_RATIO = 0.7
+
+
+def probe_image(img_file: str):
+    """
+    Format, dimensions and mode from the image header only, Image.open() does not decode the pixels
+    until they are needed. Alpha = the image has an alpha channel / transparent color, not that it is used
+    """
+    with Image.open(img_file) as img:
+        return {
+            'img_file': img_file,
+            'format': img.format,
+            'width': img.size[0],
+            'height': img.size[1],
+            'mode': img.mode,
+            'has_alpha': img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info,
+            'bytes': os.path.getsize(img_file),
+        }
+
+
+def estimate_output_bytes(probe: dict, policy: EncoderPolicy):
+
+    if probe['bytes'] < policy.min_bytes:
+        return probe['bytes']
+
+    if probe['has_alpha'] and probe['format'] == 'PNG':
+        ratio = ALPHA_SIZE_RATIO
+    else:
+        ratio = ESTIMATED_SIZE_RATIOS.get(probe['format'], 1.0)
+    longer_side = max(probe['width'], probe['height'])
+    if longer_side > policy.max_dimension:
+        ratio *= (policy.max_dimension / longer_side) ** 2
+
+    return min(int(probe['bytes'] * ratio), probe['bytes'])
+
+
+def has_transparency(img):
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        return img.convert('RGBA').getchannel('A').getextrema()[0] < 255
+    return False
+
+
+def get_psnr(img1, img2):
+
+    diff = ImageChops.difference(img1, img2)
+    mse = sum(ImageStat.Stat(diff).sum2) / (img1.size[0] * img1.size[1] * len(img1.getbands()))
+    if mse == 0:
+        return math.inf
+
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def encode_image(img, fmt: str, policy: EncoderPolicy):
+
+    buffer = BytesIO()
+    if fmt == 'JPEG':
+        img.convert('RGB').save(buffer, format='JPEG', quality=policy.jpeg_quality, subsampling=policy.subsampling,
+                                optimize=True)
+    elif fmt == 'WEBP':
+        img.save(buffer, format='WEBP', quality=policy.webp_quality, method=4)
+    else:
+        img.save(buffer, format=fmt, optimize=True)
+
+    return buffer.getvalue()
+
+
+def choose_encoding(img_file: str, policy: EncoderPolicy):
+    """
+    Trial-encodes the image in memory with every format of the policy, and returns the (format, encoded bytes)
+    of the smallest one that is within the quality threshold, or (None, None) if the file is best left as it is
+    """
+    size = os.path.getsize(img_file)
+    if size < policy.min_bytes:
+        return None, None
+
+    with Image.open(img_file) as img:
+        img.load()
+        resized = max(img.size) > policy.max_dimension
+        if resized:
+            img.thumbnail((policy.max_dimension, policy.max_dimension), Image.LANCZOS)
+
+        # JPEG would turn the transparent background black
+        transparent = has_transparency(img)
+        reference = img.convert('RGBA' if transparent else 'RGB')
+
+        best_format, best_data = None, None
+        for fmt in policy.formats:
+            if fmt == 'JPEG' and transparent:
+                continue
+            data = encode_image(reference, fmt, policy)
+            if best_data is not None and len(data) >= len(best_data):
+                continue
+            with Image.open(BytesIO(data)) as decoded:
+                if get_psnr(reference, decoded.convert(reference.mode)) >= policy.min_psnr:
+                    best_format, best_data = fmt, data
+
+    if best_data is None or (len(best_data) >= size and not resized):
+        return None, None
+
+    return best_format, best_data
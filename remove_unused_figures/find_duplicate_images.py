@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import logging
+import os
+
+from utils import (IMAGE_REF_PATTERN, IMAGE_EXTENSIONS, DUPLICATES_FOLDER, scan_vault, get_inventory_files,
+                   get_move_folders, normalize_image_name, replace_ref_in_text, build_basename_index,
+                   get_absolute_img_path)
+from move_journal import get_move_target, move_files
+
+# the first 64 kB rule out most of the same-sized files without reading them fully
+HEAD_BYTES = 64 * 1024
+BLOCK_BYTES = 2 ** 20
+
+
+def parse_args_to_dict():
+
+    parser = argparse.ArgumentParser(
+        description="Find duplicate images (same content) in the knowledge base, and optionally keep only one copy."
+    )
+    parser.add_argument(
+        "-i",
+        "--input-folder",
+        type=str,
+        required=True,
+        default="/home/petteri/Dropbox/KnowledgeBase",
+        help="Knowledge base folder.",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=str,
+        required=False,
+        default="report",
+        choices=["report", "hardlink", "rewrite"],
+        help="report: only list the duplicates, hardlink: replace the duplicates with hardlinks to one copy, "
+             "rewrite: point the .md references to one copy and move the other copies away",
+    )
+    args_dict = vars(parser.parse_args())
+
+    return args_dict
+
+
+def hash_file(path: str, n_bytes: int = None):
+
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        if n_bytes is not None:
+            digest.update(f.read(n_bytes))
+        else:
+            for block in iter(lambda: f.read(BLOCK_BYTES), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def group_by(paths, key):
+    groups = {}
+    for path in paths:
+        groups.setdefault(key(path), []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicate_files(vault_files: list):
+    """
+    Staged duplicate search: same size -> same hash of the first 64 kB -> same full BLAKE2 hash,
+    so that only the files that are still possible duplicates are read (fully).
+    Returns sorted groups of paths with identical content, already hardlinked copies are counted once
+    """
+    sizes = {f.path: f.size for f in vault_files}
+    duplicates = []
+
+    for same_size in group_by(sizes, key=lambda path: sizes[path]):
+        if sizes[same_size[0]] == 0:
+            continue
+
+        # hardlinks of the same file are not duplicates taking extra space
+        inodes = {}
+        for path in same_size:
+            stat = os.stat(path)
+            inodes.setdefault((stat.st_dev, stat.st_ino), path)
+        same_size = list(inodes.values())
+
+        for same_head in group_by(same_size, key=lambda path: hash_file(path, HEAD_BYTES)):
+            if sizes[same_head[0]] <= HEAD_BYTES:
+                duplicates.append(sorted(same_head))
+            else:
+                duplicates += [sorted(group) for group in group_by(same_head, key=hash_file)]
+
+    return sorted(duplicates)
+
+
+def files_have_same_content(path1: str, path2: str):
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    if hash_file(path1, HEAD_BYTES) != hash_file(path2, HEAD_BYTES):
+        return False
+    return os.path.getsize(path1) <= HEAD_BYTES or hash_file(path1) == hash_file(path2)
+
+
+def choose_canonical(group: list):
+    # the copy closest to the vault root, e.g. the shared attachments folder over a per-note folder
+    return min(group, key=lambda path: (path.count(os.path.sep), path))
+
+
+def hardlink_duplicates(duplicates: list):
+
+    linked, failed = 0, []
+    for group in duplicates:
+        canonical = choose_canonical(group)
+        for path in group:
+            if path == canonical:
+                continue
+            tmp_path = path + '.dedupe_tmp'
+            try:
+                os.link(canonical, tmp_path)
+                os.replace(tmp_path, path)
+                linked += 1
+            except OSError as e:
+                # e.g. on a different filesystem than the canonical copy
+                logging.warning(f"Could not hardlink {path} to {canonical}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                failed.append(path)
+
+    logging.info(f"Replaced {linked} duplicates with hardlinks ({len(failed)} failed)")
+
+    return failed
+
+
+def resolve_ref_to_file(ref: str, md_file: str, basename_index: dict):
+
+    if 'http' in ref:
+        return None
+
+    # only if unambiguous, a wrong guess would point the note to another image
+    candidates = get_absolute_img_path(ref, basename_index, md_file)
+    if candidates is not None and len(candidates) == 1:
+        return candidates[0]
+
+    return None
+
+
+def get_new_ref(ref: str, is_wikilink: bool, md_file: str, input_folder: str, canonical: str):
+
+    if is_wikilink:
+        # wikilinks are resolved from the vault root
+        return os.path.relpath(canonical, input_folder).replace(os.path.sep, '/')
+
+    new_ref = os.path.relpath(canonical, os.path.dirname(md_file)).replace(os.path.sep, '/')
+    if ' ' not in ref:
+        new_ref = new_ref.replace(' ', '%20')
+
+    return new_ref
+
+
+def rewrite_refs_to_canonical(md_files: list, duplicates: list, input_folder: str, img_files: list):
+    """
+    Point the references of the duplicates to the canonical copy. Returns the duplicates that are safe to
+    remove, i.e. the ones that no ambiguous reference (e.g. bare file name in several folders) can point to
+    """
+    canonical_of = {path: choose_canonical(group) for group in duplicates for path in group}
+    basename_index = build_basename_index(img_files)
+
+    unresolved_names = set()
+    notes_changed = 0
+    for md_file in md_files:
+        with open(md_file, 'r') as f:
+            text = f.read()
+
+        replacements = []
+        for match in IMAGE_REF_PATTERN.finditer(text):
+            group_name = 'wiki' if match.group('wiki') else ('angle' if match.group('angle') else 'path')
+            ref = match.group(group_name)
+            img_file = resolve_ref_to_file(ref, md_file, basename_index)
+            if img_file is None:
+                unresolved_names.add(normalize_image_name(ref))
+            elif img_file in canonical_of and img_file != canonical_of[img_file]:
+                new_ref = get_new_ref(ref, group_name == 'wiki', md_file, input_folder, canonical_of[img_file])
+                replacements.append((match.span(group_name), new_ref))
+
+        if len(replacements) > 0:
+            tmp_path = md_file + '.dedupe_tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(replace_ref_in_text(text, replacements))
+            os.replace(tmp_path, md_file)
+            notes_changed += 1
+            logging.debug(f"Pointed {len(replacements)} references to the canonical copies in {md_file}")
+
+    removable = [path for path, canonical in canonical_of.items()
+                 if path != canonical and normalize_image_name(path) not in unresolved_names]
+    logging.info(f"Rewrote the references in {notes_changed} .md files, "
+                 f"{len(removable)} duplicates are not referenced anymore")
+
+    return removable
+
+
+def move_duplicates_away(removable: list, input_folder: str, threads: int = 8):
+
+    # the same journaled, never overwriting moves as for the unreferenced images, so that these can be
+    # rolled back too (remove_unused_figures.py --rollback -o <input folder>/duplicates_to_be_deleted)
+    move_folder = os.path.join(input_folder, DUPLICATES_FOLDER)
+    taken = set()
+    moved_files = [get_move_target(path, input_folder, move_folder, taken) for path in removable]
+    moved, failed = move_files(removable, moved_files, move_folder, threads=threads)
+    logging.info(f"Moved {len(moved)} duplicates to {move_folder} ({len(failed)} could not be moved)")
+
+    return moved, failed
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args_to_dict()
+
+    # the files already moved away are not candidates for the canonical copy, nor duplicates to move again
+    inventory = scan_vault(args["input_folder"], exclude_folders=get_move_folders(args["input_folder"]))
+    img_files = get_inventory_files(inventory, IMAGE_EXTENSIONS)
+    duplicates = find_duplicate_files(img_files)
+
+    sizes = {f.path: f.size for f in img_files}
+    reclaimable = sum(sizes[group[0]] * (len(group) - 1) for group in duplicates)
+    logging.info(f"Found {len(duplicates)} groups of duplicate images, "
+                 f"{reclaimable / 10 ** 6:.2f} MB could be reclaimed")
+    for group in duplicates:
+        canonical = choose_canonical(group)
+        logging.info(f"  {canonical} <- {[path for path in group if path != canonical]}")
+
+    if args["mode"] == "hardlink":
+        hardlink_duplicates(duplicates)
+    elif args["mode"] == "rewrite":
+        md_files = [f.path for f in get_inventory_files(inventory, ['.md'])]
+        removable = rewrite_refs_to_canonical(md_files, duplicates, args["input_folder"],
+                                              img_files=[f.path for f in img_files])
+        move_duplicates_away(removable, args["input_folder"])
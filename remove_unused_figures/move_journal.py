@@ -0,0 +1,204 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+JOURNAL_FILENAME = 'move_journal.jsonl'
+
+# moves per journal write (and fsync), an interrupted run has to re-check at most one batch
+MOVE_BATCH_SIZE = 500
+
+
+def get_journal_path(move_folder: str):
+    return os.path.join(move_folder, JOURNAL_FILENAME)
+
+
+def get_move_target(input_file: str, input_folder: str, move_folder: str, taken: set):
+    """
+    <move_folder>/<file name>, or <file name>_<hash of the source folder> if the name is already taken
+    (e.g. image1.png from several Google Docs imports), so that the moved files never overwrite each other
+    """
+    fname = os.path.basename(input_file).replace(' ', '%20')
+    target = os.path.join(move_folder, fname)
+    if target in taken or os.path.lexists(target):
+        source_folder = os.path.relpath(os.path.dirname(input_file), input_folder)
+        stem, ext = os.path.splitext(fname)
+        suffix = hashlib.blake2b(source_folder.encode('utf-8'), digest_size=4).hexdigest()
+        target = os.path.join(move_folder, f'{stem}_{suffix}{ext}')
+        n = 1
+        while target in taken or os.path.lexists(target):
+            target = os.path.join(move_folder, f'{stem}_{suffix}_{n}{ext}')
+            n += 1
+    taken.add(target)
+
+    return target
+
+
+def append_to_journal(journal_path: str, records: list):
+
+    # write-ahead: the records are on disk before the files they describe are touched
+    with open(journal_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_journal(journal_path: str):
+    """
+    Returns the latest record of every move {dst: {'state', 'src', 'dst', 'size'}}, the states being
+    "planned" -> "moved" / "failed", and "rolling_back" -> "rolled_back" for the undone moves
+    """
+    records = {}
+    if not os.path.exists(journal_path):
+        return records
+
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # torn last line of a run that was killed while writing the journal
+                logging.warning(f"Skipping a corrupted line of {journal_path}")
+                continue
+            records[record['dst']] = record
+
+    return records
+
+
+def copy_across_devices(src: str, dst: str):
+    try:
+        shutil.move(src, dst)
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def execute_moves(moves: list, threads: int = 8):
+    """
+    Moves [(src, dst)] and returns the error (or None) of every move. Renames within the filesystem are
+    instant and done one by one, the moves across devices (copy + delete) are run in a thread pool
+    """
+    errors = [None] * len(moves)
+    cross_device = []
+    for i, (src, dst) in enumerate(moves):
+        if os.path.lexists(dst):
+            # os.rename() would silently overwrite it
+            errors[i] = f"{dst} already exists"
+            continue
+        try:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                cross_device.append(i)
+            else:
+                errors[i] = str(e)
+
+    if len(cross_device) > 0:
+        logging.info(f"Moving {len(cross_device)} files across devices with {threads} threads...")
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for i, error in zip(cross_device,
+                                executor.map(lambda i: copy_across_devices(*moves[i]), cross_device)):
+                errors[i] = error
+
+    return errors
+
+
+def run_journaled_moves(records: list, journal_path: str, start_state: str, done_state: str,
+                        reverse: bool = False, threads: int = 8):
+
+    # the earlier states and errors of the journal records are not carried over
+    records = [{'src': record['src'], 'dst': record['dst'], 'size': record['size']} for record in records]
+    done, failed = [], []
+    for start in range(0, len(records), MOVE_BATCH_SIZE):
+        batch = records[start:start + MOVE_BATCH_SIZE]
+        append_to_journal(journal_path, [dict(record, state=start_state) for record in batch])
+
+        moves = [(record['dst'], record['src']) if reverse else (record['src'], record['dst']) for record in batch]
+        results = []
+        for record, error in zip(batch, execute_moves(moves, threads=threads)):
+            if error is None:
+                results.append(dict(record, state=done_state))
+                done.append(record)
+            else:
+                logging.warning(f"Could not move {record['src']} -> {record['dst']}: {error}")
+                # a failed rollback leaves the file in the move folder, i.e. still "moved"
+                results.append(dict(record, state='moved' if reverse else 'failed', error=error))
+                failed.append(record)
+        append_to_journal(journal_path, results)
+
+    return done, failed
+
+
+def move_files(input_files: list, moved_files: list, move_folder: str, threads: int = 8):
+    """
+    Journaled moves of input_files -> moved_files, returns the moved and the failed journal records
+    """
+    os.makedirs(move_folder, exist_ok=True)
+    records = []
+    for src, dst in zip(input_files, moved_files):
+        try:
+            size = os.path.getsize(src)
+        except OSError:
+            size = None
+        records.append({'src': src, 'dst': dst, 'size': size})
+
+    return run_journaled_moves(records, get_journal_path(move_folder), start_state='planned', done_state='moved',
+                               threads=threads)
+
+
+def resume_moves(move_folder: str, threads: int = 8):
+    """
+    Finish the moves that an interrupted run had planned but not marked as done
+    """
+    journal_path = get_journal_path(move_folder)
+    pending = [record for record in read_journal(journal_path).values() if record['state'] == 'planned']
+    if len(pending) == 0:
+        return [], []
+
+    logging.info(f"Resuming {len(pending)} moves of an interrupted run from {journal_path}")
+    finished, to_move = [], []
+    for record in pending:
+        src_exists, dst_exists = os.path.lexists(record['src']), os.path.lexists(record['dst'])
+        if dst_exists and not src_exists:
+            finished.append(dict(record, state='moved'))
+        elif src_exists and dst_exists and os.path.getsize(record['dst']) >= os.path.getsize(record['src']):
+            # not a partial copy, leave both for the user to check
+            finished.append(dict(record, state='failed', error='source and target both exist'))
+        elif src_exists:
+            if dst_exists:
+                # partial copy of an interrupted cross-device move
+                os.remove(record['dst'])
+            to_move.append(record)
+        else:
+            finished.append(dict(record, state='failed', error='source and target both missing'))
+    append_to_journal(journal_path, finished)
+
+    moved, failed = run_journaled_moves(to_move, journal_path, start_state='planned', done_state='moved',
+                                        threads=threads)
+    return [record for record in finished if record['state'] == 'moved'] + moved, failed
+
+
+def rollback_moves(move_folder: str, threads: int = 8):
+    """
+    Move every file of the journal back to where it was. Can be re-run if interrupted
+    """
+    journal_path = get_journal_path(move_folder)
+    to_restore = []
+    for record in reversed(list(read_journal(journal_path).values())):
+        if record['state'] == 'rolling_back' and os.path.lexists(record['src']) \
+                and not os.path.lexists(record['dst']):
+            append_to_journal(journal_path, [dict(record, state='rolled_back')])
+        elif record['state'] in ('moved', 'rolling_back'):
+            to_restore.append(record)
+
+    logging.info(f"Rolling back {len(to_restore)} moves from {journal_path}")
+    restored, failed = run_journaled_moves(to_restore, journal_path, start_state='rolling_back',
+                                           done_state='rolled_back', reverse=True, threads=threads)
+    logging.info(f"Moved {len(restored)} files back ({len(failed)} failed)")
+
+    return restored, failed
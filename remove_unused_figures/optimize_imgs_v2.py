@@ -1,14 +1,20 @@
 import argparse
 import glob
+import json
 import logging
 import os
 import re
-import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import unquote
 
 from PIL import Image
 
+from encoder_policy import (EncoderPolicy, DEFAULT_FORMATS, FORMAT_EXTENSIONS, get_supported_formats,
+                            choose_encoding, probe_image, estimate_output_bytes)
 from remove_unused_figures import get_disk_use, get_img_refs_from_md_files
-from utils import get_image_refs_of_line, create_hash, hash_suffix_str
+from utils import (get_image_refs_of_line, create_hash, hash_suffix_str, has_hash_suffix, scan_vault,
+                   get_inventory_files, replace_ref_in_text, IMAGE_EXTENSIONS, IMAGE_REF_PATTERN)
 
 
 def parse_args_to_dict():
@@ -24,6 +30,55 @@ def parse_args_to_dict():
         default="/home/petteri/Dropbox/KnowledgeBase",
         help="Where is / are your .tex files located?",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=os.cpu_count(),
+        help="Number of processes for converting the images",
+    )
+    parser.add_argument(
+        "--formats",
+        type=str,
+        required=False,
+        default=",".join(fmt.lower() for fmt in DEFAULT_FORMATS),
+        help="Formats to try for every image, the smallest one within --min-psnr is kept "
+             "(webp only if Pillow has the WebP support)",
+    )
+    parser.add_argument(
+        "--min-psnr",
+        type=float,
+        required=False,
+        default=40.0,
+        help="Quality threshold (PSNR in dB, against the original) for the lossy formats",
+    )
+    parser.add_argument(
+        "--min-kb",
+        type=float,
+        required=False,
+        default=100,
+        help="Images smaller than this (kB) are not re-encoded",
+    )
+    parser.add_argument(
+        "--max-dimension",
+        type=int,
+        required=False,
+        default=2560,
+        help="Images larger than this (px, longer side) are downscaled",
+    )
+    parser.add_argument(
+        "--plan-file",
+        type=str,
+        required=False,
+        default=None,
+        help="Write the conversion plan (image headers and the estimated savings) as JSON to this file",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only plan the conversions (no pixels decoded), do not convert the images or touch the notes",
+    )
     args_dict = vars(parser.parse_args())
 
     return args_dict
@@ -31,7 +86,7 @@ def parse_args_to_dict():
 
 def get_all_img_files(input_folder, folders=('Attachments', 'figures')):
 
-    ext = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg']
+    ext = ['*' + e for e in IMAGE_EXTENSIONS]
     if isinstance(ext, list):
         files = []
         for e in ext:
@@ -39,7 +94,6 @@ def get_all_img_files(input_folder, folders=('Attachments', 'figures')):
                 files_e = glob.glob(os.path.join(input_folder, folder, e), recursive=True)
                 files += files_e
                 # files_e = glob.glob(os.path.join(input_folder, '**', e), recursive=True)
-            files += files_e
         files = sorted(files)
         logging.info(f"Found {len(files)} (multiple extensions: {ext}) files from {input_folder}\n"
                      f"\tvalid folders: {folders}")
@@ -99,105 +153,285 @@ def optimize_imgs_references(lines, img_files, md_fname, input_folder):
     return lines_out, lines_changed, skipped
 
 
-def rename_extension_of_refs(img_refs, lines, unique_hash):
+def rename_extension_of_refs(img_refs, lines, renamed):
+    """
+    img_refs: the references of this note, renamed: {file name: new file name} of the converted images.
+    The references can have the file names with spaces or with %20
+    """
+    lines_as_str = ''.join(lines)
 
-    hash_string = hash_suffix_str(unique_hash)
+    # nothing to do for the notes that do not reference any of the converted images
+    if not any(unquote(os.path.basename(img_ref)) in renamed for img_ref in img_refs):
+        return lines_as_str
 
-    lines_as_str = ''.join(lines)
-    for img_ref in img_refs:
-        base_name = os.path.basename(img_ref)
-        fname, ext = os.path.splitext(base_name)
-        if ext == '.jpeg':
-            lines_as_str = lines_as_str.replace(f'{base_name}', f'{fname}{hash_string}.jpg')
-        elif ext == '.png':
-            lines_as_str = lines_as_str.replace(f'{base_name}', f'{fname}{hash_string}.jpg')
-        elif ext == '.jpg':
-            if len(hash_string) > 0:
-                lines_as_str = lines_as_str.replace(f'{base_name}', f'{fname}{hash_string}.jpg')
-        elif ext == '.ico':
-            a = 1
-        #elif ext == '.gif':
-        #    lines_as_str = lines_as_str.replace(f'{base_name}', f'{fname}.jpg')
-        else:
-            a = 1
+    # one pass over the note, and only the file names of the image references are replaced, not the same
+    # names in the text (e.g. "myimage a.png" or a name mentioned in the prose)
+    replacements = []
+    for match in IMAGE_REF_PATTERN.finditer(lines_as_str):
+        group_name = 'wiki' if match.group('wiki') else ('angle' if match.group('angle') else 'path')
+        base_name = os.path.basename(match.group(group_name))
+        new_name = renamed.get(unquote(base_name))
+        if new_name is not None:
+            _, end = match.span(group_name)
+            replacements.append(((end - len(base_name), end),
+                                 new_name.replace(' ', '%20') if '%20' in base_name else new_name))
 
-    return lines_as_str
+    return replace_ref_in_text(lines_as_str, replacements)
 
 
-def process_md_file(md_file, img_refs, unique_hash, export_on=True):
+def process_md_file(md_file, img_refs, renamed, export_on=True):
 
     with open(md_file, 'r') as f:
         lines = f.readlines()
 
-    # batch convert all pngs to jpgs, and rename jpeg to jpg on Bash then
-    lines_out = rename_extension_of_refs(img_refs, lines, unique_hash)
+    lines_out = rename_extension_of_refs(img_refs, lines, renamed)
 
     os.rename(md_file, md_file + '.bakMDupp')
     with open(md_file, 'w') as f:
         f.writelines(lines_out)
 
 
-def process_md_files_for_optimization(input_folder, use_hash: bool = True):
+def process_md_files_for_optimization(input_folder, use_hash: bool = True, jobs: int = 1,
+                                      policy: EncoderPolicy = EncoderPolicy(), plan_file: str = None,
+                                      dry_run: bool = False):
 
-    md_files = sorted(glob.glob(os.path.join(input_folder, '**', '*.md'), recursive=True))
-    img_refs = get_img_refs_from_md_files(md_files, args["input_folder"])
+    md_files = [f.path for f in get_inventory_files(scan_vault(input_folder), ['.md'])]
+    note_tasks = []
 
     for i, md_file in enumerate(md_files):
 
         if use_hash:
-            unique_hash = create_hash()
+            unique_hash = create_hash(os.path.relpath(md_file, input_folder))
         else:
             unique_hash = None
 
         base_dir, fname = os.path.split(md_file)
         fname, ext = os.path.splitext(fname)
         logging.info(f"Processing {i + 1}/{len(md_files)}: {fname}")
-        im_refs_file = img_refs[fname.replace(' ', '_')]
-
-        process_md_file(md_file, img_refs, unique_hash)
 
         # TODO! Notion-specific, update for something more general
         img_files = get_all_img_files(input_folder=os.path.join(base_dir, fname),
                                       folders=('Attachments', 'figures'))
-        batch_convert_images(img_files,
-                             unique_hash=unique_hash)
-
-        time.sleep(1)
-
-
-def batch_convert_images(img_files, quality=85, subsampling=0, unique_hash=None):
-
+        note_tasks.append((md_file, plan_image_conversions(img_files, policy=policy, unique_hash=unique_hash)))
+
+    tasks = drop_colliding_tasks([task for _, tasks in note_tasks for task in tasks])
+    plan = plan_from_image_headers(tasks, policy, jobs=jobs)
+    if plan_file is not None:
+        with open(plan_file, 'w') as f:
+            json.dump(plan, f, indent=2)
+        logging.info(f"Saved the conversion plan to {plan_file}")
+    if dry_run:
+        logging.info("Dry run, no images converted and no notes changed")
+        return
+
+    # the images that Pillow could not even identify would only fail in the pool
+    probed = {entry['img_file'] for entry in plan['images']}
+    tasks = [task for task in tasks if task[0] in probed]
+
+    # Convert first, as the output format (i.e. the new name) of an image is only known after the trial encodings.
+    # One pool for the images of all the notes, instead of a pool per note of a few images
+    results = run_image_conversions(tasks, jobs=jobs)
+    # the notes are read only now, the dry run (plan) does not need their references
+    img_refs = get_img_refs_from_md_files(md_files, input_folder)
+    output_files = {task[0]: img_file_out for task, error, _, _, img_file_out, _ in results if error is None}
+
+    for md_file, tasks in note_tasks:
+        renamed = {os.path.basename(task[0]): os.path.basename(output_files[task[0]])
+                   for task in tasks if output_files.get(task[0], task[0]) != task[0]}
+        if len(renamed) > 0:
+            process_md_file(md_file, img_refs[md_file], renamed)
+
+
+def plan_image_conversions(img_files, policy: EncoderPolicy = EncoderPolicy(), unique_hash=None):
+    """
+    (img_file, output path without the extension, policy) for the .png/.jpeg/.jpg images, the extension
+    coming from the format that the policy picks
+    """
     hash_string = hash_suffix_str(unique_hash)
 
     def correct_format(ext):
-        return ext == '.png' or ext == '.jpeg'
+        return ext == '.png' or ext == '.jpeg' or ext == '.jpg'
 
-    for i, img_file in enumerate(img_files):
+    sources = []
+    for img_file in img_files:
         fname = os.path.basename(img_file)
         fname, ext = os.path.splitext(fname)
+        img_file = img_file.replace('%20', ' ')
+        if correct_format(ext) and not has_hash_suffix(img_file, unique_hash):
+            sources.append((img_file, fname.replace('%20', ' '), ext))
+
+    # a.png and a.jpg in the same folder would both become e.g. a_<hash>.jpg, so these keep
+    # the source extension in the name (a_png_<hash>, a_jpg_<hash>)
+    stem_counts = Counter(os.path.join(os.path.dirname(img_file), fname).casefold()
+                          for img_file, fname, _ in sources)
+
+    tasks = []
+    for img_file, fname, ext in sources:
+        if stem_counts[os.path.join(os.path.dirname(img_file), fname).casefold()] > 1:
+            fname = f'{fname}_{ext[1:]}'
+        img_file_out_stem = os.path.join(os.path.dirname(img_file), f'{fname}{hash_string}')
+        if any(os.path.exists(img_file_out_stem + ext_out) for ext_out in FORMAT_EXTENSIONS.values()
+               if img_file_out_stem + ext_out != img_file):
+            # converted on an earlier run, the names are deterministic
+            continue
+        tasks.append((img_file, img_file_out_stem, policy))
+
+    return tasks
+
+
+def drop_colliding_tasks(tasks):
+    """
+    Last check before converting: two tasks with the same output stem would overwrite each other's output
+    (or race in the pool), so neither of them is run
+    """
+    stem_counts = Counter(task[1].casefold() for task in tasks)
+    colliding = [task for task in tasks if stem_counts[task[1].casefold()] > 1]
+    for task in colliding:
+        logging.error(f"Not converting {task[0]}, another image would get the same name {task[1]}.*")
+
+    return [task for task in tasks if stem_counts[task[1].casefold()] == 1]
+
+
+def probe_image_of_task(task):
+    try:
+        return probe_image(task[0]), None
+    except Exception as e:
+        return None, str(e)
+
+
+def plan_from_image_headers(tasks, policy: EncoderPolicy = EncoderPolicy(), jobs: int = 1):
+    """
+    Conversion plan from the image headers and file sizes only, i.e. without decoding any pixels:
+    {'summary': {...}, 'images': [header + action + estimated bytes], 'not_identified': [...]}
+    """
+    # opening the files is I/O bound, threads are enough
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        probes = list(executor.map(probe_image_of_task, tasks))
+
+    images, not_identified = [], []
+    for task, (probe, error) in zip(tasks, probes):
+        if probe is None:
+            logging.warning(f"Could not read the header of {task[0]}: {error}")
+            not_identified.append({'img_file': task[0], 'error': error})
+            continue
+        if probe['bytes'] < policy.min_bytes:
+            probe['action'] = 'keep'
+        elif max(probe['width'], probe['height']) > policy.max_dimension:
+            probe['action'] = 'downscale'
+        else:
+            probe['action'] = 'recompress'
+        probe['estimated_bytes'] = estimate_output_bytes(probe, policy)
+        images.append(probe)
+
+    # the largest estimated savings first, i.e. the files worth converting
+    images.sort(key=lambda probe: probe['bytes'] - probe['estimated_bytes'], reverse=True)
+    bytes_in = sum(probe['bytes'] for probe in images)
+    estimated_bytes = sum(probe['estimated_bytes'] for probe in images)
+    summary = {
+        'images': len(images),
+        'not_identified': len(not_identified),
+        **{action: sum(1 for probe in images if probe['action'] == action)
+           for action in ('keep', 'downscale', 'recompress')},
+        'bytes': bytes_in,
+        'estimated_bytes': estimated_bytes,
+        'estimated_savings': bytes_in - estimated_bytes,
+    }
+    logging.info(f"Plan: {summary['recompress']} images to recompress, {summary['downscale']} to downscale, "
+                 f"{summary['keep']} small enough to keep, {summary['not_identified']} not identified: "
+                 f"{bytes_in / 10 ** 6:.2f} MB -> ~{estimated_bytes / 10 ** 6:.2f} MB (estimate)")
+
+    return {'summary': summary, 'images': images, 'not_identified': not_identified}
+
+
+def convert_image(task):
+    """
+    Runs in the worker processes, returns (task, error or None, bytes in, bytes out, output file, action)
+    """
+    img_file, img_file_out_stem, policy = task
+    try:
+        bytes_in = os.path.getsize(img_file)
+        fmt, data = choose_encoding(img_file, policy)
+        if fmt is None:
+            # already small enough, only the (hashed) name changes
+            img_file_out = img_file_out_stem + os.path.splitext(img_file)[1]
+            if img_file_out == img_file:
+                return task, None, bytes_in, bytes_in, img_file_out, 'kept'
+            if os.path.exists(img_file_out):
+                raise FileExistsError(f"{img_file_out} already exists")
+            os.rename(img_file, img_file_out)
+            return task, None, bytes_in, bytes_in, img_file_out, 'renamed'
+
+        img_file_out = img_file_out_stem + FORMAT_EXTENSIONS[fmt]
+        if img_file_out == img_file:
+            # same name and format, e.g. an optimized PNG without the hash suffix
+            os.rename(img_file, img_file + '.bakIMG')
+        # claim the name atomically, so that an output of another task (or any existing file) is never overwritten
+        os.close(os.open(img_file_out, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        try:
+            with open(img_file_out + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(img_file_out + '.tmp', img_file_out)
+        except BaseException:
+            for path in (img_file_out, img_file_out + '.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        if img_file_out != img_file:
+            os.rename(img_file, img_file + '.bakIMG')
+        return task, None, bytes_in, len(data), img_file_out, f'converted ({fmt})'
+    except Exception as e:
+        return task, str(e), 0, 0, None, 'failed'
+
+
+def run_image_conversions(tasks, jobs=1, max_in_flight=None):
+    """
+    Convert the images in a process pool, with at most max_in_flight tasks submitted at a time (so that
+    the pending futures of 100k images are not all in memory), logging the results as they complete
+    """
+    if max_in_flight is None:
+        max_in_flight = 4 * jobs
+
+    results = []
+
+    def log_result(result):
+        task, error, bytes_in, bytes_out, img_file_out, action = result
+        results.append(result)
+        if error is not None:
+            logging.error(f"#{len(results)}/{len(tasks)}: Could not convert {task[0]}: {error}")
+        elif action == 'kept':
+            logging.debug(f"#{len(results)}/{len(tasks)}: Kept {os.path.basename(task[0])} as it is")
+        else:
+            logging.info(f"#{len(results)}/{len(tasks)}: {action[0].upper() + action[1:]} {os.path.basename(task[0])} "
+                         f"to {os.path.basename(img_file_out)} ({bytes_in / 10 ** 3:.0f} -> {bytes_out / 10 ** 3:.0f} kB)")
+
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            in_flight = set()
+            for task in tasks:
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        log_result(future.result())
+                in_flight.add(executor.submit(convert_image, task))
+            for future in wait(in_flight).done:
+                log_result(future.result())
+    else:
+        for task in tasks:
+            log_result(convert_image(task))
 
-        if correct_format(ext):
-
-            img_file = img_file.replace('%20', ' ')
-            img = Image.open(img_file)
-            img = img.convert('RGB')
-            img_file_out = img_file.replace('.png', '.jpg').replace('.jpeg', '.jpg').replace('.gif', '.jpg')
-            img_file_out = img_file_out.replace('.jpg', f'{hash_string}.jpg')
+    n_failed = sum(1 for result in results if result[1] is not None)
+    n_kept = sum(1 for result in results if result[5] == 'kept')
+    bytes_in = sum(result[2] for result in results)
+    bytes_out = sum(result[3] for result in results)
+    logging.info(f"Processed {len(results)} images ({n_kept} kept as they are, {n_failed} failed): "
+                 f"{bytes_in / 10 ** 6:.2f} MB -> {bytes_out / 10 ** 6:.2f} MB")
 
-            logging.info(f"#{i + 1}/{len(img_files)}: Converting {fname} to {os.path.basename(img_file_out)}")
-            img.save(img_file_out, format='JPEG', subsampling=subsampling, quality=quality)
-            os.rename(img_file, img_file + '.bakIMG')
+    return results
 
-        elif ext == '.jpg':
 
-            if len(hash_string) > 0:
-                logging.info(f"#{i}/{len(img_files)}: Renaming {fname} to {fname}{hash_string}.jpg")
-                img_file = img_file.replace('%20', ' ')
-                img_file_out = img_file.replace('.jpg', f'{hash_string}.jpg')
-                try:
-                    os.rename(img_file, img_file_out)
-                except Exception as e:
-                    logging.error(f"Error: {e}")
+def batch_convert_images(img_files, policy: EncoderPolicy = EncoderPolicy(), unique_hash=None, jobs=1):
+    tasks = plan_image_conversions(img_files, policy=policy, unique_hash=unique_hash)
+    return run_image_conversions(tasks, jobs=jobs)
 
 
 if __name__ == "__main__":
@@ -206,6 +440,18 @@ if __name__ == "__main__":
     args = parse_args_to_dict()
 
     use_hash = True
+    formats = tuple(fmt.strip().upper() for fmt in args["formats"].split(','))
+    if get_supported_formats(formats) != formats:
+        logging.warning("Pillow was built without the WebP support, not trying WebP")
+        formats = get_supported_formats(formats)
+    policy = EncoderPolicy(formats=formats,
+                           min_psnr=args["min_psnr"],
+                           min_bytes=int(args["min_kb"] * 10 ** 3),
+                           max_dimension=args["max_dimension"])
 
     process_md_files_for_optimization(input_folder = args["input_folder"],
-                                      use_hash = use_hash)
+                                      use_hash = use_hash,
+                                      jobs = args["jobs"],
+                                      policy = policy,
+                                      plan_file = args["plan_file"],
+                                      dry_run = args["dry_run"])
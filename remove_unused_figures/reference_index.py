@@ -0,0 +1,159 @@
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+
+from utils import normalize_image_name, scan_vault, get_inventory_files, IMAGE_EXTENSIONS
+
+# bump when the tables or the reference parsing change, so that the index is rebuilt
+INDEX_SCHEMA_VERSION = 2
+
+
+def parse_args_to_dict():
+
+    parser = argparse.ArgumentParser(
+        description="Query the note <-> attachment reference index of the vault."
+    )
+    parser.add_argument(
+        "-i",
+        "--input-folder",
+        type=str,
+        required=True,
+        default="/home/petteri/Dropbox/KnowledgeBase",
+        help="Knowledge base folder.",
+    )
+    parser.add_argument(
+        "-index",
+        "--reference-index",
+        type=str,
+        required=False,
+        default=None,
+        help="SQLite index file, by default in the knowledge base folder",
+    )
+    parser.add_argument(
+        "-ref",
+        "--referencing",
+        type=str,
+        required=False,
+        default=None,
+        help="List the notes that reference this attachment (file name, with or without the path)",
+    )
+    parser.add_argument(
+        "--orphans",
+        action="store_true",
+        help="List the attachments that are not referenced from any note",
+    )
+    args_dict = vars(parser.parse_args())
+
+    return args_dict
+
+
+def get_default_index_path(input_folder: str):
+    return os.path.join(input_folder, '.reference_index.sqlite')
+
+
+def open_reference_index(index_path: str):
+
+    con = sqlite3.connect(index_path)
+    con.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    version = con.execute("SELECT value FROM meta WHERE name = 'schema_version'").fetchone()
+    if version is None or version[0] != str(INDEX_SCHEMA_VERSION):
+        if version is not None:
+            logging.info(f"Reference index {index_path} is from an older version, rebuilding")
+        with con:
+            con.execute('DROP TABLE IF EXISTS notes')
+            con.execute('DROP TABLE IF EXISTS edges')
+            con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('schema_version', str(INDEX_SCHEMA_VERSION)))
+
+    with con:
+        con.execute('CREATE TABLE IF NOT EXISTS notes '
+                    '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+        con.execute('CREATE TABLE IF NOT EXISTS edges (note TEXT, ref TEXT, ref_name TEXT)')
+        con.execute('CREATE INDEX IF NOT EXISTS edges_note ON edges (note)')
+        con.execute('CREATE INDEX IF NOT EXISTS edges_ref_name ON edges (ref_name)')
+
+    return con
+
+
+def update_reference_index(con, md_files: list, get_refs_of_file):
+    """
+    Re-parse only the notes that are new or changed (size/mtime, and then content hash) since the
+    previous update, and drop the notes that do not exist anymore. Returns the number of re-parsed notes
+    """
+    known_notes = {path: (size, mtime_ns, content_hash) for path, size, mtime_ns, content_hash
+                   in con.execute('SELECT path, size, mtime_ns, hash FROM notes')}
+    reparsed = 0
+
+    with con:
+        for md_file in md_files:
+            stat = os.stat(md_file)
+            known = known_notes.get(md_file)
+            if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                continue
+
+            with open(md_file, 'rb') as f:
+                content_hash = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+            if known is None or known[2] != content_hash:
+                refs = get_refs_of_file(md_file)
+                con.execute('DELETE FROM edges WHERE note = ?', (md_file,))
+                con.executemany('INSERT INTO edges VALUES (?, ?, ?)',
+                                ((md_file, ref, normalize_image_name(ref)) for ref in refs))
+                reparsed += 1
+            con.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?)',
+                        (md_file, stat.st_size, stat.st_mtime_ns, content_hash))
+
+        removed = set(known_notes) - set(md_files)
+        con.executemany('DELETE FROM edges WHERE note = ?', ((note,) for note in removed))
+        con.executemany('DELETE FROM notes WHERE path = ?', ((note,) for note in removed))
+
+    logging.info(f"Reference index: re-parsed {reparsed}/{len(md_files)} notes, removed {len(removed)} notes")
+
+    return reparsed
+
+
+def get_img_refs_from_index(con):
+    # {note: [refs]}, also for the notes without any references
+    img_refs = {path: [] for (path,) in con.execute('SELECT path FROM notes ORDER BY path')}
+    for note, ref in con.execute('SELECT note, ref FROM edges ORDER BY rowid'):
+        img_refs[note].append(ref)
+    return img_refs
+
+
+def get_notes_referencing(con, img_file: str):
+    return [note for (note,) in con.execute('SELECT DISTINCT note FROM edges WHERE ref_name = ? ORDER BY note',
+                                            (normalize_image_name(img_file),))]
+
+
+def get_orphaned_images(con, img_files: list):
+    referenced = {ref_name for (ref_name,) in con.execute('SELECT DISTINCT ref_name FROM edges')}
+    return [img_file for img_file in img_files if normalize_image_name(img_file) not in referenced]
+
+
+if __name__ == "__main__":
+
+    from remove_unused_figures import get_image_refs_of_file
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args_to_dict()
+    index_path = args['reference_index'] or get_default_index_path(args['input_folder'])
+
+    inventory = scan_vault(args['input_folder'])
+    con = open_reference_index(index_path)
+    update_reference_index(con, [f.path for f in get_inventory_files(inventory, ['.md'])],
+                           get_refs_of_file=lambda md_file: get_image_refs_of_file(md_file, relative_base_path=''))
+
+    if args['referencing'] is not None:
+        notes = get_notes_referencing(con, args['referencing'])
+        logging.info(f"{len(notes)} notes reference {args['referencing']}:")
+        for note in notes:
+            print(note)
+
+    if args['orphans']:
+        img_files = [f.path for f in get_inventory_files(inventory, IMAGE_EXTENSIONS)]
+        orphans = get_orphaned_images(con, img_files)
+        logging.info(f"{len(orphans)}/{len(img_files)} attachments are not referenced from any note:")
+        for orphan in orphans:
+            print(orphan)
+
+    con.close()
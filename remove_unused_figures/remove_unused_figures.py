@@ -1,10 +1,14 @@
 import argparse
-import glob
 import logging
+import multiprocessing
 import os
 import re
 
-from utils import get_image_refs_of_line
+from utils import (get_image_refs_of_text, build_reference_index, find_unreferenced_files,
+                   build_multi_pattern_matcher, find_patterns_in_text, scan_vault, get_inventory_files,
+                   is_in_folder, IMAGE_EXTENSIONS, UNREFERENCED_FOLDER, VaultFile)
+from reference_index import open_reference_index, update_reference_index, get_img_refs_from_index
+from move_journal import get_move_target, move_files, resume_moves, rollback_moves
 
 
 def parse_args_to_dict():
@@ -20,22 +24,59 @@ def parse_args_to_dict():
         default="/home/petteri/Dropbox/KnowledgeBase",
         help="Where is / are your .tex files located?",
     )
+    parser.add_argument(
+        "-index",
+        "--reference-index",
+        type=str,
+        required=False,
+        default=None,
+        help="Keep the note -> image references in this SQLite file, and re-parse only the changed notes "
+             "on the next runs (see also reference_index.py for querying it)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of processes for reading the image references from the .md files",
+    )
+    parser.add_argument(
+        "-o",
+        "--move-folder",
+        type=str,
+        required=False,
+        default=None,
+        help="Where to move the unreferenced images, by default attachments_not_referenced in the input folder",
+    )
+    parser.add_argument(
+        "--move-threads",
+        type=int,
+        required=False,
+        default=8,
+        help="Number of threads for the moves across devices (copy + delete)",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Move the files of the previous runs back to where they were (from the move journal), and exit",
+    )
     args_dict = vars(parser.parse_args())
 
     return args_dict
 
 
-def get_all_files(input_folder, ext = '*.md'):
+def get_all_files(input_folder, ext = '*.md', inventory = None):
+
+    # one walk for all the extensions, or no walk at all if you already have the inventory of the vault
+    if inventory is None:
+        inventory = scan_vault(input_folder)
 
     if isinstance(ext, list):
-        files = []
-        for e in ext:
-            files_e = glob.glob(os.path.join(input_folder, '**', e), recursive=True)
-            files += files_e
-        files = sorted(files)
+        files = [f.path for f in get_inventory_files(inventory, [e.lstrip('*') for e in ext])]
         logging.info(f"Found {len(files)} (multiple extensions: {ext}) files from {input_folder}")
     else:
-        files = glob.glob(os.path.join(input_folder, '**', ext), recursive=True)
+        files = [f.path for f in get_inventory_files(inventory, [ext.lstrip('*')])]
         logging.info(f"Found {len(files)} {ext} files from {input_folder}")
     return files
 
@@ -44,6 +85,10 @@ def get_disk_use(files):
     sizes = []
     not_found = []
     for f in files:
+        if isinstance(f, VaultFile):
+            # size from the stat of the vault scan
+            sizes.append(f.size)
+            continue
         f = f.replace('%20', ' ')
         try:
             sizes.append(os.path.getsize(f))
@@ -56,50 +101,64 @@ def get_disk_use(files):
 
 
 def get_kb_files(args):
-    md_files = sorted(get_all_files(args["input_folder"]))
+    inventory = scan_vault(args["input_folder"])
+
+    md_files = get_inventory_files(inventory, ['.md'])
     md_size, not_found = get_disk_use(md_files)
+    logging.info(f"Found {len(md_files)} .md files from {args['input_folder']}")
     logging.info(f"Total size of .md files: {md_size/10**6:.2f} MB")
-    logging.info(f"Average md file size: {md_size/len(md_files)/10**3:.2f} kB")
+    logging.info(f"Average md file size: {md_size/max(len(md_files), 1)/10**3:.2f} kB")
 
-    img_files = sorted(get_all_files(args["input_folder"], ext=['*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg']))
+    img_files = get_inventory_files(inventory, IMAGE_EXTENSIONS)
     img_size, not_found2 = get_disk_use(img_files)
+    logging.info(f"Found {len(img_files)} (extensions: {IMAGE_EXTENSIONS}) files from {args['input_folder']}")
     logging.info(f"Total size of image files: {img_size/10**9:.2f} GB")
-    logging.info(f"Average image file size: {img_size/len(img_files)/10**3:.2f} kB")
+    logging.info(f"Average image file size: {img_size/max(len(img_files), 1)/10**3:.2f} kB")
 
-    return md_files, img_files
+    return [f.path for f in md_files], [f.path for f in img_files]
 
 
 def get_image_refs_of_file(f, relative_base_path):
 
-    img_refs = []
     with open(f, 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            refs = get_image_refs_of_line(line)
-            if refs is not None:
-                img_refs.append(refs)
-
-    # flatten Python list
-    img_refs = [item for sublist in img_refs for item in sublist]
+        img_refs = get_image_refs_of_text(file.read())
 
     return img_refs
 
 
-def get_img_refs_from_md_files(md_files, input_folder):
+def get_image_refs_of_md_file(f):
+    return get_image_refs_of_file(f, relative_base_path='')
+
 
-    img_refs = {}
-    for i, f in enumerate(md_files):
-        logging.info(f"Reading {f}")
-        relative_base_path = os.path.dirname(f).replace(input_folder, '')
-        if len(relative_base_path) > 0:
-            if relative_base_path[0] == os.path.sep:
-                relative_base_path = relative_base_path[1:]
-        refs_per_file = get_image_refs_of_file(f, relative_base_path)
-        filename = os.path.basename(f).replace('.md', '').replace(' ', '_')
-        img_refs[filename] = refs_per_file
-        logging.info(f"Found {len(refs_per_file)} image references in {f}")
+def get_img_refs_from_md_files(md_files, input_folder, index_path = None, jobs = 1):
+    """
+    Returns {md_file: [image references]}, keyed with the full path of the note, as the same note name
+    (e.g. "README") can be in several folders
+    """
+    if index_path is not None:
+        # only the new/changed notes are parsed, the rest of the references come from the index
+        con = open_reference_index(index_path)
+        try:
+            update_reference_index(con, md_files, get_refs_of_file=get_image_refs_of_md_file)
+            refs_per_note = get_img_refs_from_index(con)
+        finally:
+            con.close()
+        return {f: refs_per_note.get(f, []) for f in md_files}
+
+    if jobs > 1 and len(md_files) > 1:
+        # chunks of notes per task, a single note is too little work to be worth the inter-process overhead
+        chunksize = max(1, len(md_files) // (jobs * 8))
+        with multiprocessing.Pool(jobs) as pool:
+            refs_per_file = pool.map(get_image_refs_of_md_file, md_files, chunksize=chunksize)
+    else:
+        refs_per_file = [get_image_refs_of_md_file(f) for f in md_files]
+
+    img_refs = dict(zip(md_files, refs_per_file))
+    for f, refs in img_refs.items():
+        logging.debug(f"Found {len(refs)} image references in {f}")
+    logging.info(f"Found {sum(len(refs) for refs in img_refs.values())} image references "
+                 f"in {len(md_files)} .md files.")
 
-    #logging.info(f"Found {len(img_refs)} image references in {len(md_files)} .md files.")
     return img_refs
 
 
@@ -127,25 +186,29 @@ def fill_whitespaces_in_fnames(img_refs_stripped):
     return img_refs_stripped_filled
 
 
-def check_if_images_on_disk_are_referenced(img_refs, img_files, input_folder):
+def get_default_move_folder(input_folder):
+    return os.path.join(input_folder, UNREFERENCED_FOLDER)
+
+
+def check_if_images_on_disk_are_referenced(img_refs, img_files, input_folder, move_folder = None):
 
     # create a folder where all not referenced images are moved
-    move_folder = os.path.join(input_folder, 'attachments_not_referenced')
+    if move_folder is None:
+        move_folder = get_default_move_folder(input_folder)
     os.makedirs(move_folder, exist_ok=True)
     moved_files = []
     input_files = []
 
-    img_refs_list = [item for sublist in img_refs.values() for item in sublist]
-    img_refs_stripped = strip_subdirs_from_imagepaths(img_refs_list)
-    img_refs_stripped = fill_whitespaces_in_fnames(img_refs_stripped)
-
-    for i, filepath in enumerate(img_files):
-        img_file = os.path.basename(filepath)
-        img_file = replace_whitespace_in_fname(img_file)
-        if img_file not in img_refs_stripped:
-            moved_file = os.path.join(input_folder, 'attachments_not_referenced', img_file)
-            moved_files.append(moved_file)
-            input_files.append(filepath)
+    # unique target names, e.g. image1.png of several Google Docs imports would overwrite each other
+    taken = set()
+    reference_index = build_reference_index(img_refs)
+    for filepath in find_unreferenced_files(img_files, reference_index):
+        if is_in_folder(filepath, move_folder):
+            # already moved on a previous run
+            continue
+        moved_file = get_move_target(filepath, input_folder, move_folder, taken)
+        moved_files.append(moved_file)
+        input_files.append(filepath)
 
     return input_files, moved_files, move_folder
 
@@ -173,64 +236,73 @@ def remove_referenced_files(input_files, moved_files, actually_referenced):
 def doublecheck_that_not_referenced_in_md_files(md_files, moved_files, input_files):
 
     assert len(moved_files) == len(input_files), "The number of moved files and input files should be the same."
-    actually_referenced = []
+
+    # the file names can be written with spaces or with %20 in the .md files
+    candidate_names = {}
+    for input_file, moved_file in zip(input_files, moved_files):
+        basefilename = os.path.basename(input_file)
+        for name in (basefilename, replace_whitespace_in_fname(basefilename)):
+            candidate_names.setdefault(name, set()).add(moved_file)
+    matcher = build_multi_pattern_matcher(candidate_names)
 
     logging.info(f"DOUBLECHECK:")
+    referenced = set()
     for i, md_file in enumerate(md_files):
 
-        logging.info(f"Checking {md_file}")
+        logging.debug(f"Checking {md_file}")
         with open(md_file, 'r') as file:
-            lines = file.readlines()
-            file_as_string = ''.join(lines)
+            file_as_string = file.read()
 
-        for (input_file, moved_file) in zip(input_files, moved_files):
-            basefilename = os.path.basename(moved_file)
-            if basefilename in file_as_string:
-                actually_referenced.append(moved_file)
+        for name in find_patterns_in_text(file_as_string, matcher):
+            referenced.update(candidate_names[name])
 
+    actually_referenced = [moved_file for moved_file in moved_files if moved_file in referenced]
     input_out, moved_out = remove_referenced_files(input_files, moved_files, actually_referenced)
 
     logging.info(f"DOUBLECHECK: Found {len(actually_referenced)} images that are actually referenced in .md files.")
     logging.info(f"DOUBLECHECK: Still {len(moved_out)} images that are not referenced in .md files.")
 
-    # TODO! you could check for unique naming here, as e.g. Google Docs import like just sequential naming, so you
-    #  get the same names in multiple folders, and then you would overwrite the files (not_referenced folder)
-
     return input_out, moved_out, actually_referenced
 
 
 def move_the_unreferenced_files(input_files, moved_files, input_folder, move_folder,
-                                move=True):
+                                move=True, threads=8):
 
     logging.info(f"Moving {len(moved_files)} files to {move_folder}...")
-    not_moved = []
 
     if move:
-        for i, (input_file, moved_file) in enumerate(zip(input_files, moved_files)):
-            try:
-                os.rename(input_file, moved_file)
-            except Exception as e:
-                not_moved.append((input_file, moved_file))
+        # every move is logged to the journal of the move folder first, see --rollback
+        moved, not_moved = move_files(input_files, moved_files, move_folder, threads=threads)
     else:
         logging.warning("Files were not moved, as move=False was set. (DEBUG mode)")
+        moved, not_moved = [], []
 
-    actually_moved_files = get_all_files(move_folder, ext=['*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg'])
-    logging.info(f"Moved {len(actually_moved_files)} files to {move_folder}.")
-    freed_up_disk_space, _ = get_disk_use(actually_moved_files)
+    logging.info(f"Moved {len(moved)} files to {move_folder} ({len(not_moved)} could not be moved).")
+    freed_up_disk_space = sum(record['size'] or 0 for record in moved)
     logging.info(f"Freed up {freed_up_disk_space / 10 ** 6:.2f} MB of disk space.")
 
+    return moved, not_moved
+
 
 if __name__ == "__main__":
 
     logging.basicConfig(level=logging.INFO)
     args = parse_args_to_dict()
-    md_files, img_files = get_kb_files(args)
-
-    img_refs = get_img_refs_from_md_files(md_files, args["input_folder"])
-    input_files, moved_files, move_folder = (
-        check_if_images_on_disk_are_referenced(img_refs, img_files, args["input_folder"]))
-    input_files, moved_files, actually_referenced = (
-        doublecheck_that_not_referenced_in_md_files(md_files, moved_files, input_files))
+    move_folder = args["move_folder"] or get_default_move_folder(args["input_folder"])
 
-    move_the_unreferenced_files(input_files, moved_files, args["input_folder"], move_folder,
-                                move=True)
+    if args["rollback"]:
+        rollback_moves(move_folder, threads=args["move_threads"])
+    else:
+        # finish the moves of an interrupted run before looking at the vault
+        resume_moves(move_folder, threads=args["move_threads"])
+        md_files, img_files = get_kb_files(args)
+
+        img_refs = get_img_refs_from_md_files(md_files, args["input_folder"], index_path=args["reference_index"],
+                                              jobs=args["jobs"])
+        input_files, moved_files, move_folder = (
+            check_if_images_on_disk_are_referenced(img_refs, img_files, args["input_folder"], move_folder=move_folder))
+        input_files, moved_files, actually_referenced = (
+            doublecheck_that_not_referenced_in_md_files(md_files, moved_files, input_files))
+
+        move_the_unreferenced_files(input_files, moved_files, args["input_folder"], move_folder,
+                                    move=True, threads=args["move_threads"])
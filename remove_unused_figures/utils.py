@@ -1,6 +1,18 @@
+import hashlib
+import logging
 import os
 import re
-import time
+from collections import namedtuple
+from urllib.parse import unquote
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp')
+
+# where remove_unused_figures.py and find_duplicate_images.py move the files, i.e. not part of the vault anymore
+UNREFERENCED_FOLDER = 'attachments_not_referenced'
+DUPLICATES_FOLDER = 'duplicates_to_be_deleted'
+
+# path, size in bytes and modification time from the os.scandir() walk of the vault
+VaultFile = namedtuple('VaultFile', ['path', 'size', 'mtime'])
 
 
 def hash_suffix_str(unique_hash):
@@ -10,41 +22,37 @@ def hash_suffix_str(unique_hash):
         return ''
 
 
-def create_hash(n = 10):
-    return '{0:010x}'.format(int(time.time() * 256))[:n]
+def create_hash(key: str, n = 10):
+    # derived from e.g. the note path, so the same note always gets the same suffix on every run and in
+    # every process, and different notes get different suffixes without waiting for the clock to tick
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()[:n]
 
 
-def get_image_refs_of_line(line):
+def has_hash_suffix(fname: str, unique_hash):
+    # already renamed on an earlier run
+    stem, _ = os.path.splitext(os.path.basename(fname))
+    return unique_hash is not None and stem.endswith(hash_suffix_str(unique_hash))
 
-    line = line.replace('> ', '').replace('>', '')
 
-    #pattern1 = '!\[.*\]\(.*.\)'
-    pattern2 = r'!\[\[\D*\d*\.\D{3,4}]]' # https://stackoverflow.com/q/68813348
-    pattern3 = '!\[[^\]]*\]\((.*?)\s*("(?:.*[^"])")?\s*\)' # https://stackoverflow.com/a/44227600
+# One pass for both of the image reference syntaxes:
+#  "wiki": ![[image.png]], ![[folder/Pasted image 2024.png|300]] (size suffix), ![[image.png#anchor]]
+#  "angle" / "path": ![alt](path/image.png), ![alt](path/image.png "title"), ![alt](<path with spaces.png>)
+# The wikilinks need a file extension, as ![[Some note]] embeds a note and not an image
+IMAGE_REF_PATTERN = re.compile(
+    r'!\[\[(?P<wiki>[^\]|#\n]+?\.[A-Za-z][A-Za-z0-9]{1,4})(?:#[^\]|\n]*)?(?:\|[^\]\n]*)?\]\]'
+    r'|!\[[^\]\n]*\]\(\s*(?:<(?P<angle>[^>\n]+)>|(?P<path>[^)\s]+(?: [^)\s"]+)*?))(?:\s+"[^"\n]*")?\s*\)'
+)
 
-    #match1 = [x.group() for x in re.finditer(pattern1, line)]
-    match2 = [x.group() for x in re.finditer(pattern2, line)]
-    match3 = [x.group() for x in re.finditer(pattern3, line)]
-    matches = match2 + match3
-    image_paths = return_image_paths(matches)
 
-    if image_paths is not None:
-        return image_paths
-    else:
-        return None
+def get_image_refs_of_text(text):
+    # whole file at once, the pattern does not need any per-line cleaning (e.g. "> " of the quotes)
+    return [match.group('wiki') or match.group('angle') or match.group('path')
+            for match in IMAGE_REF_PATTERN.finditer(text)]
 
 
-def return_image_paths(matches):
+def get_image_refs_of_line(line):
 
-    image_paths = []
-    for ms in matches:
-        if ms is not None:
-            if '![[' in ms:
-                image_path = ms.split('[[')[1].split(']]')[0]
-                image_paths.append(image_path)
-            else:
-                image_path = ms.split('](')[1].split(')')[0]
-                image_paths.append(image_path)
+    image_paths = get_image_refs_of_text(line)
 
     if len(image_paths) > 0:
         return image_paths
@@ -52,17 +60,173 @@ def return_image_paths(matches):
         return None
 
 
-def get_absolute_img_path(ref, img_files):
+def replace_ref_in_text(text: str, replacements: list):
+    # [((start, end), new_ref)] from the IMAGE_REF_PATTERN match spans, so that only the reference is replaced
+    # and not the same string elsewhere in the text (e.g. "image1.png" inside "myimage1.png")
+    parts, previous_end = [], 0
+    for (start, end), new_ref in sorted(replacements):
+        parts += [text[previous_end:start], new_ref]
+        previous_end = end
+    parts.append(text[previous_end:])
+    return ''.join(parts)
 
-    ref = ref.replace(' ', '%20')
-    ref = os.path.basename(ref) # get the basename of the image reference
-    res = [i for i in img_files if ref in i]
-    if len(res) > 0:
-        if len(res) == 1:
-            return res
-        else:
-            # TODO! You could either have the same exact image in different folders,
-            #  or you could have non-unique filenames
-            return res
-    else:
-        return None
\ No newline at end of file
+
+def normalize_image_name(path: str):
+    # the same image can be referenced as "Pasted image.png", "Pasted%20image.png", "../Attachments/pasted image.png"
+    return unquote(os.path.basename(path.replace('\\', '/'))).casefold()
+
+
+def get_path_components(path: str):
+    return [part for part in unquote(os.path.normpath(path.replace('\\', '/'))).casefold().split('/') if part]
+
+
+def build_basename_index(img_files):
+    # {normalized basename: [paths]}, built once so that every reference is resolved with a dict lookup
+    basename_index = {}
+    for img_file in img_files:
+        basename_index.setdefault(normalize_image_name(img_file), []).append(img_file)
+    return basename_index
+
+
+def get_path_match_score(img_file: str, ref: str, md_file: str = None):
+
+    img_parts = get_path_components(img_file)
+    ref_parts = get_path_components(ref)
+    relative_match = False
+    folder_parts = []
+    if md_file is not None:
+        folder_parts = get_path_components(os.path.dirname(md_file))
+        relative_match = img_parts == get_path_components(os.path.join(os.path.dirname(md_file), ref))
+
+    # the folders of the reference itself, e.g. "Attachments/image1.png" or "Project/Attachments/image1.png"
+    n_ref_folders = 0
+    for img_part, ref_part in zip(reversed(img_parts[:-1]), reversed(ref_parts[:-1])):
+        if img_part != ref_part:
+            break
+        n_ref_folders += 1
+
+    # and then the closest one to the note, e.g. the "Attachments" next to it
+    n_common_folders = 0
+    for img_part, folder_part in zip(img_parts[:-1], folder_parts):
+        if img_part != folder_part:
+            break
+        n_common_folders += 1
+
+    return relative_match, n_ref_folders, n_common_folders
+
+
+def get_absolute_img_path(ref, basename_index: dict, md_file: str = None):
+    """
+    Files matching the basename of the reference exactly (so "image1.png" does not match "image11.png").
+    Non-unique names (e.g. image1.png from every Google Docs import) are disambiguated by the folders in the
+    reference and by the folder of the referencing note. Returns the best matching file(s) or None,
+    more than one only if the reference stays ambiguous
+    """
+    candidates = basename_index.get(normalize_image_name(ref))
+    if candidates is None:
+        return None
+    if len(candidates) == 1:
+        return list(candidates)
+
+    scores = [get_path_match_score(candidate, ref, md_file) for candidate in candidates]
+    best_score = max(scores)
+    return [candidate for candidate, score in zip(candidates, scores) if score == best_score]
+
+
+def build_reference_index(img_refs):
+    """
+    Hashed set of the normalized basenames of the image references, either from the {md_file: [refs]}
+    dictionary of get_img_refs_from_md_files(), or from any iterable of references
+    """
+    if isinstance(img_refs, dict):
+        img_refs = (ref for refs in img_refs.values() for ref in refs)
+    return {normalize_image_name(ref) for ref in img_refs}
+
+
+def find_unreferenced_files(img_files, reference_index: set):
+    # linear in the number of files, as the lookups are set lookups
+    return [img_file for img_file in img_files if normalize_image_name(img_file) not in reference_index]
+
+
+def build_multi_pattern_matcher(patterns):
+    """
+    Matcher for finding many file names (e.g. "image1.png") as substrings of a text in one pass.
+    The text is scanned once for the file extensions of the patterns, and at every extension hit
+    the preceding substrings of the pattern lengths are looked up from hashed sets. Unlike a regex
+    alternation, overlapping matches are found as well (e.g. "image1.png" in "myimage1.png")
+    """
+    patterns_by_length = {}
+    extensions = set()
+    for pattern in patterns:
+        _, ext = os.path.splitext(pattern)
+        if len(ext) == 0:
+            raise ValueError(f"Pattern without a file extension: {pattern}")
+        patterns_by_length.setdefault(len(pattern), set()).add(pattern)
+        extensions.add(ext)
+
+    # longest extensions first, so that ".jpeg" is not cut to ".jpe" by some other pattern
+    extensions = sorted(extensions, key=len, reverse=True)
+    return {'extension_pattern': re.compile('|'.join(re.escape(ext) for ext in extensions)) if extensions else None,
+            'patterns_by_length': patterns_by_length}
+
+
+def find_patterns_in_text(text: str, matcher: dict):
+
+    found = set()
+    if matcher['extension_pattern'] is None:
+        return found
+
+    for match in matcher['extension_pattern'].finditer(text):
+        end = match.end()
+        for length, patterns in matcher['patterns_by_length'].items():
+            if length <= end and text[end - length:end] in patterns:
+                found.add(text[end - length:end])
+
+    return found
+
+
+def get_move_folders(input_folder: str):
+    return [os.path.join(input_folder, UNREFERENCED_FOLDER), os.path.join(input_folder, DUPLICATES_FOLDER)]
+
+
+def is_in_folder(path: str, folder: str):
+    # absolute paths, as e.g. the move folder can be given relative to the working directory
+    folder = os.path.abspath(folder)
+    return os.path.commonpath([os.path.abspath(path), folder]) == folder
+
+
+def scan_vault(input_folder: str, exclude_folders=()):
+    """
+    Inventory of the vault with a single os.scandir() walk: {extension (lowercase): [VaultFile]},
+    the sizes and modification times coming from the same stat() as the listing.
+    Hidden files and folders (e.g. .obsidian, .trash) are skipped like glob('**') does, and so are
+    the exclude_folders (e.g. the move folders of get_move_folders())
+    """
+    excluded = {os.path.abspath(folder) for folder in exclude_folders}
+    inventory = {}
+    folders = [input_folder]
+    while len(folders) > 0:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        if os.path.abspath(entry.path) not in excluded:
+                            folders.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        inventory.setdefault(ext, []).append(VaultFile(entry.path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            logging.warning(f"Could not list {folder}: {e}")
+
+    for files in inventory.values():
+        files.sort()
+
+    return inventory
+
+
+def get_inventory_files(inventory: dict, extensions=IMAGE_EXTENSIONS):
+    return sorted(vault_file for ext in extensions for vault_file in inventory.get(ext, []))